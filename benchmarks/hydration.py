@@ -0,0 +1,138 @@
+import os
+import sys
+import time
+from collections import OrderedDict
+from copy import deepcopy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sql_orm import postgresql
+from sql_orm.postgresql import datatypes, objects, sql
+from db_models.models import InterBankTransaction, Transactions
+
+
+class FakePostgreSQL:
+
+    rows = 0
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def close(self):
+        pass
+
+    def fetch_query_results(self, sql, params=None, event=None):
+        width = sql.split(" FROM ", 1)[0].count(",") + 1
+        row = tuple(range(1, width + 1))
+        for _ in range(self.rows):
+            yield row
+
+
+class BaselineDecoder:
+    # Per-row hydration as it was before RowDecoder: every row splits the column names, scans the joined
+    # proxies and deep copies the foreign key fields. Kept here only as the reference for the benchmark.
+
+    def __init__(self, table_class, base_table_proxy, table_details, columns_order, annotations=()):
+        self.__table_class = table_class
+        self.__base_table_proxy = base_table_proxy
+        self.__table_details = table_details
+        self.__columns_order = columns_order
+        self.has_deferred = False
+
+    def decode(self, column_values, loaders=None):
+        data_map = {}
+        used_proxies = []
+        for i in range(len(column_values)):
+            p, c = self.__columns_order[i].split(".")
+            if p not in data_map:
+                data_map[p] = {}
+            data_map[p][c] = column_values[i]
+        data_map = OrderedDict(sorted([(k, v) for k, v in data_map.items()], key=lambda x: x[0]))
+
+        def get_table_proxy(tbl_class, base_tbl_class, f_key):
+            for proxy_k, proxy_v in self.__table_details.items():
+                conditions = (
+                    proxy_v["details"]["fk_table_class"] == tbl_class and
+                    proxy_v["details"]["base_table_class"] == base_tbl_class and
+                    proxy_v["details"]["key"] == f_key
+                )
+                if conditions and proxy_k not in used_proxies:
+                    used_proxies.append(proxy_k)
+                    return proxy_k
+            return
+
+        def fill_table_attributes(proxy_name):
+            if proxy_name == self.__base_table_proxy:
+                table_class = self.__table_class
+            else:
+                table_class = self.__table_details[proxy_name]["details"]["fk_table_class"]
+            obj = table_class()
+            for column in table_class.get_column_names():
+                if isinstance(table_class.__dict__[column], datatypes.ForeignKeyField):
+                    obj_fk_table_class = getattr(table_class.__dict__[column], "table_name")
+                    fk_proxy = get_table_proxy(
+                        tbl_class=obj_fk_table_class,
+                        base_tbl_class=table_class,
+                        f_key=column
+                    )
+                    if fk_proxy:
+                        setattr(obj, column, fill_table_attributes(fk_proxy))
+                    else:
+                        obj_f_key = deepcopy(table_class.__dict__[column])
+                        obj_f_key.set_value(data_map[proxy_name][column])
+                        setattr(obj, column, obj_f_key)
+                else:
+                    setattr(obj, column, data_map[proxy_name][column])
+            return obj
+
+        return fill_table_attributes(proxy_name=self.__base_table_proxy)
+
+
+def with_decoder(decoder_class, function):
+    # Compiled queries keep their decoder, so the query cache is cleared on both sides of the swap.
+    original = objects.RowDecoder
+    objects.RowDecoder = decoder_class
+    sql.QUERY_CACHE.clear()
+    try:
+        return function()
+    finally:
+        objects.RowDecoder = original
+        sql.QUERY_CACHE.clear()
+
+
+def rows_per_second(row_set_factory, rows, repeat=3):
+    FakePostgreSQL.rows = rows
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in row_set_factory():
+            pass
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return rows / best
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    postgresql.PostgreSQL = FakePostgreSQL
+    cases = (
+        ("plain", lambda: Transactions.objects.all()),
+        ("select_related 3 levels", lambda: InterBankTransaction.objects.select_related(
+            "banks_involved__depositor__currency")),
+    )
+    print("{:<25} {:>14} {:>14} {:>8}".format("", "baseline", "RowDecoder", "speedup"))
+    for name, factory in cases:
+        baseline = with_decoder(BaselineDecoder, lambda: rows_per_second(factory, rows))
+        current = rows_per_second(factory, rows)
+        print("{:<25} {:>14,.0f} {:>14,.0f} {:>7.1f}x".format(name, baseline, current, current / baseline))
+    print("rows/sec, {:,} rows, best of 3".format(rows))
+
+
+if __name__ == '__main__':
+    main()
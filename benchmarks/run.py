@@ -0,0 +1,191 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sql_orm import postgresql
+from sql_orm.postgresql import sql
+from db_models.models import Bank, Currency, InterBankTransaction, Transactions
+from hydration import FakePostgreSQL, rows_per_second
+
+
+BENCHMARK_CURRENCY = "BMK"
+BENCHMARK_BANK = "Benchmark bank"
+
+
+def best_of(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def result(value, unit, higher_is_better):
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+
+def compile_query():
+    return sql.Query(
+        schema=Transactions.get_schema(),
+        table_class=Transactions,
+        table_columns=Transactions._meta.column_names,
+        pk=Transactions._meta.pk_name,
+        filter_dict={"bank__currency__code": "USD", "amount__gt": 0},
+        select_related=["bank"],
+        limit=100
+    )
+
+
+def fake_driver_cases(rows, repeat):
+    results = {}
+    loops = 2000
+
+    def uncached():
+        for _ in range(loops):
+            compile_query().query()
+
+    def cached():
+        for _ in range(loops):
+            compile_query().compile()
+
+    compile_query().compile()
+    results["compile.uncached"] = result(best_of(uncached, repeat) / loops * 1e6, "us/query", False)
+    results["compile.cached"] = result(best_of(cached, repeat) / loops * 1e6, "us/query", False)
+    original = postgresql.PostgreSQL
+    postgresql.PostgreSQL = FakePostgreSQL
+    try:
+        results["hydrate.plain"] = result(
+            rows_per_second(lambda: Transactions.objects.all(), rows, repeat), "rows/s", True)
+        results["hydrate.select_related"] = result(rows_per_second(
+            lambda: InterBankTransaction.objects.select_related("banks_involved__depositor__currency"), rows, repeat
+        ), "rows/s", True)
+    finally:
+        postgresql.PostgreSQL = original
+    return results
+
+
+def database_cases(rows, ops, repeat):
+    for model in (Currency, Bank, Transactions):
+        model.migrate()
+    currency, _ = Currency.objects.get_or_create(code=BENCHMARK_CURRENCY)
+    bank, _ = Bank.objects.get_or_create(name=BENCHMARK_BANK, currency=currency.id)
+    today = datetime.date.today()
+
+    def transactions(count):
+        return [
+            {"date_of_entry": today, "datetime_of_entry": None, "amount": i, "status": False, "bank": bank.id}
+            for i in range(count)
+        ]
+
+    def clean():
+        Transactions.objects.filter(bank=bank.id).delete()
+
+    results = {}
+    try:
+        clean()
+        data = transactions(rows)
+        elapsed = best_of(lambda: (clean(), Transactions.objects.bulk_create(data)), repeat)
+        results["bulk_create.copy"] = result(rows / elapsed, "rows/s", True)
+        elapsed = best_of(lambda: (clean(), Transactions.objects.bulk_create(data, return_ids=True)), repeat)
+        results["bulk_create.returning"] = result(rows / elapsed, "rows/s", True)
+
+        elapsed = best_of(lambda: [i for i in Transactions.objects.filter(bank=bank.id)], repeat)
+        results["iterate.plain"] = result(rows / elapsed, "rows/s", True)
+        elapsed = best_of(lambda: [i for i in Transactions.objects.select_related("bank__currency").filter(bank=bank.id)], repeat)
+        results["iterate.select_related"] = result(rows / elapsed, "rows/s", True)
+
+        count_loops = max(ops // 10, 1)
+        elapsed = best_of(lambda: [Transactions.objects.filter(bank=bank.id).count() for _ in range(count_loops)], repeat)
+        results["count"] = result(elapsed / count_loops * 1000, "ms/query", False)
+
+        objects = [i for i in Transactions.objects.filter(bank=bank.id)[:ops]]
+
+        def save():
+            for obj in objects:
+                obj.amount = obj.amount + 1
+                obj.save()
+
+        results["save.update"] = result(best_of(save, repeat) / len(objects) * 1000, "ms/op", False)
+
+        def create():
+            for i in range(ops):
+                Transactions.objects.create(date_of_entry=today, amount=i, status=False, bank=bank.id)
+
+        results["save.insert"] = result(best_of(create, repeat) / ops * 1000, "ms/op", False)
+
+        def lazy_load():
+            for obj in Transactions.objects.filter(bank=bank.id)[:ops]:
+                obj.bank.name
+
+        elapsed = best_of(lambda: [i for i in Transactions.objects.filter(bank=bank.id)[:ops]], repeat)
+        results["fk.lazy_load"] = result((best_of(lazy_load, repeat) - elapsed) / ops * 1000, "ms/access", False)
+    finally:
+        clean()
+        bank.delete()
+        currency.delete()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    print("\n{:<25} {:>14} {:>14} {:>8}".format("benchmark", "baseline", "current", "change"))
+    for name, current in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous is None or not previous["value"]:
+            continue
+        change = current["value"] / previous["value"] - 1
+        worse = -change if current["higher_is_better"] else change
+        flag = " REGRESSION" if worse > tolerance else ""
+        if flag:
+            regressions.append(name)
+        print("{:<25} {:>14,.2f} {:>14,.2f} {:>+7.1%}{}".format(name, previous["value"], current["value"], change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sql_orm benchmarks")
+    parser.add_argument("--rows", type=int, default=20000, help="rows per hydration / bulk_create benchmark")
+    parser.add_argument("--ops", type=int, default=200, help="operations per latency benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the best one is kept")
+    parser.add_argument("--fake-only", action="store_true", help="skip the benchmarks needing PostgreSQL")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against a JSON file written with --output")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown before failing")
+    args = parser.parse_args()
+
+    results = fake_driver_cases(args.rows, args.repeat)
+    if not args.fake_only:
+        results.update(database_cases(args.rows, args.ops, args.repeat))
+    for name, value in sorted(results.items()):
+        print("{:<25} {:>14,.2f} {}".format(name, value["value"], value["unit"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "meta": {
+                    "timestamp": datetime.datetime.now().isoformat(),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "rows": args.rows,
+                    "ops": args.ops,
+                    "repeat": args.repeat
+                },
+                "results": results
+            }, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -64,3 +64,19 @@ class InterBankTransaction(PostgreSQLTable):
         table_name=InterBankStatus,
         verbose_name="Inter bank trans",
     )
+
+
+class ExchangeRate(PostgreSQLTable):
+
+    _schema = "personal"
+
+    id = datatypes.DefaultPrimaryKeyField(verbose_name="ID")
+    base = datatypes.ForeignKeyField(
+        table_name=Currency,
+        verbose_name="Base currency"
+    )
+    quote = datatypes.CharField(max_length=3, verbose_name="Quote currency")
+    rate = datatypes.FloatField(verbose_name="Rate", null=True)
+
+    class Meta:
+        unique_together = (("base", "quote"), )
@@ -1,5 +1,6 @@
-import inspect
+from contextvars import ContextVar
 from copy import deepcopy
+from types import MappingProxyType
 
 
 DATABASE_TYPES = {
@@ -16,6 +17,8 @@ NON_COLUMN_FIELDS = ("__module__", "__doc__", "Meta", "_schema")
 
 class BaseField:
 
+    is_relation = False
+
     def __deepcopy__(self, memodict):
         cls = self.__class__
         result = cls.__new__(cls)
@@ -24,23 +27,67 @@ class BaseField:
         return result
 
 
+class TableMeta:
+
+    def __init__(self, table_class):
+        fields = {}
+        for k, v in table_class.__dict__.items():
+            if isinstance(v, BaseField):
+                if k != k.lower():
+                    raise SQLException("Column names should be in lowercase.")
+                fields[k] = v
+        column_names = tuple(sorted(fields))
+        pk_name = next((k for k in column_names if getattr(fields[k], "primary_key", False)), None)
+        values = {
+            "table_class": table_class,
+            "table_name": table_class.__name__.lower(),
+            "column_names": column_names,
+            "column_set": frozenset(column_names),
+            "fields": MappingProxyType({k: fields[k] for k in column_names}),
+            "pk_name": pk_name,
+            "non_pk_column_names": tuple(k for k in column_names if k != pk_name),
+            "foreign_keys": MappingProxyType({k: fields[k] for k in column_names if fields[k].is_relation}),
+            "quoted_column_names": MappingProxyType({k: '"{}"'.format(k) for k in column_names}),
+            "options": table_class.__dict__.get("Meta"),
+        }
+        for k, v in values.items():
+            object.__setattr__(self, k, v)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("TableMeta is read-only.")
+
+    def __repr__(self):
+        return "<TableMeta: {}>".format(self.table_name)
+
+
 class Table:
 
     database_type = None
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._meta = TableMeta(cls)
+
     def __init__(self, database_type, **kwargs):
         if database_type not in DATABASE_TYPES.values():
             raise SQLException("Wrong database_type. Valid options: {}".format(", ".join(DATABASE_TYPES.values())))
         self.database_type = database_type
-        for i in self.__class__.get_column_names():
+        for i in self.__class__._meta.column_names:
             self.__dict__[i] = kwargs.get(i)
+        self.__dict__["_dirty_fields"] = set(self.__class__._meta.column_names)
 
     def __getattribute__(self, item):
         if item.startswith("__"):
             return object.__getattribute__(self, item)
+        attributes = object.__getattribute__(self, "__dict__")
         try:
-            return self.__dict__[item]
+            return attributes[item]
         except KeyError:
+            loader = attributes.get("_deferred_loader")
+            if loader is not None and item in object.__getattribute__(self, "_meta").column_set:
+                loader.load(self)
+                if item in attributes:
+                    return attributes[item]
             return object.__getattribute__(self, item)
 
     def __setattr__(self, key, value):
@@ -50,30 +97,34 @@ class Table:
             self.__dict__[key] = value
         except KeyError:
             object.__setattr__(self, key, value)
+        if key in self.__class__._meta.column_set:
+            self.__dict__.setdefault("_dirty_fields", set()).add(key)
+
+    def get_dirty_fields(self):
+        return set(self.__dict__.get("_dirty_fields", ()))
+
+    def _clear_dirty_fields(self, fields=None):
+        dirty_fields = self.__dict__.setdefault("_dirty_fields", set())
+        if fields is None:
+            dirty_fields.clear()
+        else:
+            dirty_fields.difference_update(fields)
 
     @classmethod
     def _get_column_fields(cls):
-        valid_column_names = cls.get_column_names()
-        return {k: v for k, v in cls.__dict__.items() if k in valid_column_names}
+        return dict(cls._meta.fields)
 
     @classmethod
     def _get_meta_field(cls):
-        return cls.__dict__.get("Meta")
+        return cls._meta.options
 
     @classmethod
     def get_column_names(cls):
-        names = []
-        for k, v in cls.__dict__.items():
-            class_inspects = inspect.getmro(v.__class__)
-            if len(class_inspects) > 1 and class_inspects[-2] == BaseField:
-                if k != k.lower():
-                    raise SQLException("Column names should be in lowercase.")
-                names.append(k)
-        return sorted(names)
+        return list(cls._meta.column_names)
 
     @classmethod
     def get_table_name(cls):
-        return cls.__name__.lower()
+        return cls._meta.table_name
 
 
 class FKFieldTree:
@@ -100,3 +151,54 @@ class FKFieldTree:
         if not isinstance(node, FKFieldTree):
             raise ValueError("The parent should be a FieldTree instance.")
         self.parent = node
+
+
+_IDENTITY_MAP = ContextVar("sql_orm_identity_map", default=None)
+
+
+class IdentityMap:
+
+    def __init__(self):
+        self.__objects = {}
+        self.__tokens = []
+
+    def __enter__(self):
+        self.__tokens.append(_IDENTITY_MAP.set(self))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _IDENTITY_MAP.reset(self.__tokens.pop())
+
+    def __len__(self):
+        return len(self.__objects)
+
+    def get(self, table_class, pk):
+        return self.__objects.get((table_class, pk))
+
+    def add(self, obj):
+        table_class = obj.__class__
+        pk = obj.__dict__.get(table_class._meta.pk_name)
+        if pk is None:
+            return obj
+        return self.__objects.setdefault((table_class, pk), obj)
+
+    def clear(self):
+        self.__objects.clear()
+
+
+def identity_map():
+    return IdentityMap()
+
+
+def get_identity_map():
+    return _IDENTITY_MAP.get()
+
+
+def atomic(pool=None):
+    from sql_orm.postgresql import atomic as postgresql_atomic
+    return postgresql_atomic(pool=pool)
+
+
+def session(pool=None, batch_size=1000):
+    from sql_orm.postgresql.session import session as postgresql_session
+    return postgresql_session(pool=pool, batch_size=batch_size)
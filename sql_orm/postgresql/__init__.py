@@ -1,29 +1,400 @@
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.extras
 import configparser
+import contextlib
+import datetime
+import io
+import itertools
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from sql_orm.postgresql import instrumentation
 
 CONFIG = configparser.ConfigParser()
 CONFIG.read("config.ini")
 
+_SLOW_QUERY_THRESHOLD_MS = CONFIG.get("POSTGRESQL", "SLOW_QUERY_THRESHOLD_MS", fallback=None)
+instrumentation.configure(
+    slow_query_threshold=float(_SLOW_QUERY_THRESHOLD_MS) / 1000 if _SLOW_QUERY_THRESHOLD_MS else None,
+    collect_stats=CONFIG.get("POSTGRESQL", "QUERY_STATS", fallback="False") == "True"
+)
 
-class PostgreSQL:
 
-    def __init__(self):
-        credentials = {
-            "host": CONFIG["POSTGRESQL"]["DB_HOST"],
-            "port": int(CONFIG["POSTGRESQL"]["DB_PORT"]),
-            "database": CONFIG["POSTGRESQL"]["DB_NAME"],
-            "user": CONFIG["POSTGRESQL"]["DB_USER"],
-            "password": CONFIG["POSTGRESQL"]["DB_PASSWORD"]
-        }
-        self.debug = CONFIG["POSTGRESQL"].get("DEBUG") == "True"
+class PoolException(Exception):
+    pass
+
+
+def get_credentials():
+    return {
+        "host": CONFIG["POSTGRESQL"]["DB_HOST"],
+        "port": int(CONFIG["POSTGRESQL"]["DB_PORT"]),
+        "database": CONFIG["POSTGRESQL"]["DB_NAME"],
+        "user": CONFIG["POSTGRESQL"]["DB_USER"],
+        "password": CONFIG["POSTGRESQL"]["DB_PASSWORD"]
+    }
+
+
+_PLACEHOLDER = re.compile(r"%([s%])")
+
+PREPARABLE_STATEMENTS = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+
+def to_positional_placeholders(sql):
+    counter = itertools.count(1)
+    return _PLACEHOLDER.sub(lambda match: "${}".format(next(counter)) if match.group(1) == "s" else "%", sql)
+
+
+def copy_text_value(value):
+    if value is None:
+        return "\\N"
+    if value is True:
+        return "t"
+    if value is False:
+        return "f"
+    if isinstance(value, str):
+        return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+
+class PreparedStatements:
+
+    def __init__(self, threshold=5, max_size=100):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.__names = OrderedDict()
+        self.__seen = OrderedDict()
+        self.__unpreparable = set()
+        self.__ids = itertools.count()
+
+    def __len__(self):
+        return len(self.__names)
+
+    def __contains__(self, sql):
+        return sql in self.__names
+
+    def __seen_enough(self, sql):
+        count = self.__seen.pop(sql, 0) + 1
+        if count >= self.threshold:
+            return True
+        self.__seen[sql] = count
+        while len(self.__seen) > self.max_size * 10:
+            self.__seen.popitem(last=False)
+        return False
+
+    def __prepare(self, cursor, sql):
+        name = "sql_orm_stmt_{}".format(next(self.__ids))
+        statement = "PREPARE {} AS {}".format(name, to_positional_placeholders(sql).rstrip().rstrip(";"))
+        connection = cursor.connection
+        in_transaction = connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE
         try:
-            self._conn = psycopg2.connect(**credentials)
-            self._cursor = self._conn.cursor()
-            if self.debug:
-                print("\nConnected to PostgreSQL\n")
+            if in_transaction:
+                cursor.execute("SAVEPOINT sql_orm_prepare; {}; RELEASE SAVEPOINT sql_orm_prepare;".format(statement))
+            else:
+                cursor.execute(statement + ";")
+        except psycopg2.Error:
+            if in_transaction:
+                cursor.execute("ROLLBACK TO SAVEPOINT sql_orm_prepare; RELEASE SAVEPOINT sql_orm_prepare;")
+            else:
+                connection.rollback()
+            self.__unpreparable.add(sql)
+            return None
+        self.__names[sql] = name
+        while len(self.__names) > self.max_size:
+            _, evicted = self.__names.popitem(last=False)
+            cursor.execute("DEALLOCATE {};".format(evicted))
+        return name
+
+    def name_for(self, cursor, sql):
+        name = self.__names.get(sql)
+        if name is not None:
+            self.__names.move_to_end(sql)
+            return name
+        if sql in self.__unpreparable or not sql.lstrip()[:6].upper().startswith(PREPARABLE_STATEMENTS):
+            return None
+        if not self.__seen_enough(sql):
+            return None
+        return self.__prepare(cursor, sql)
+
+    def reset(self):
+        self.__names.clear()
+        self.__seen.clear()
+
+
+class PooledConnection(psycopg2.extensions.connection):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.last_used = time.monotonic()
+        self.prepared_statements = None
+
+
+class ConnectionPool:
+
+    def __init__(self, min_size=1, max_size=10, idle_timeout=300, timeout=30, check_after=5, **credentials):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise PoolException("Invalid pool size. Expected 0 <= min_size <= max_size and max_size >= 1.")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.check_after = check_after
+        self.__credentials = credentials
+        self.__idle = []
+        self.__in_use = 0
+        self.__closed = False
+        self.__condition = threading.Condition()
+        for _ in range(min_size):
+            self.__idle.append(self.__connect())
+
+    def __connect(self):
+        try:
+            return psycopg2.connect(connection_factory=PooledConnection, **self.__credentials)
         except psycopg2.Error as error:
             raise ValueError("Unable to connect to PostgreSQL database\n{error}".format(error=error))
 
+    def __is_healthy(self, conn):
+        if conn.closed or conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if time.monotonic() - conn.last_used > self.check_after:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1;")
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    @staticmethod
+    def __close_connection(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def __prune_idle(self):
+        now = time.monotonic()
+        while (
+                self.__idle and
+                len(self.__idle) + self.__in_use > self.min_size and
+                now - self.__idle[0].last_used > self.idle_timeout
+        ):
+            self.__close_connection(self.__idle.pop(0))
+
+    @property
+    def size(self):
+        with self.__condition:
+            return len(self.__idle) + self.__in_use
+
+    @property
+    def idle(self):
+        with self.__condition:
+            return len(self.__idle)
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        with self.__condition:
+            while True:
+                if self.__closed:
+                    raise PoolException("The connection pool is closed.")
+                self.__prune_idle()
+                if self.__idle:
+                    conn = self.__idle.pop()
+                    break
+                if len(self.__idle) + self.__in_use < self.max_size:
+                    conn = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolException("Timed out waiting for a PostgreSQL connection from the pool.")
+                self.__condition.wait(remaining)
+            self.__in_use += 1
+        try:
+            if conn is not None and not self.__is_healthy(conn):
+                self.__close_connection(conn)
+                conn = None
+            if conn is None:
+                conn = self.__connect()
+        except Exception:
+            with self.__condition:
+                self.__in_use -= 1
+                self.__condition.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, discard=False):
+        if not conn.closed and not discard:
+            status = conn.get_transaction_status()
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                discard = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+        with self.__condition:
+            self.__in_use -= 1
+            if discard or conn.closed or self.__closed:
+                self.__close_connection(conn)
+            else:
+                conn.last_used = time.monotonic()
+                self.__idle.append(conn)
+            self.__condition.notify()
+
+    def closeall(self):
+        with self.__condition:
+            self.__closed = True
+            while self.__idle:
+                self.__close_connection(self.__idle.pop())
+            self.__condition.notify_all()
+
+
+_CURSOR_IDS = itertools.count()
+
+_POOL = None
+_POOL_PID = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool():
+    global _POOL, _POOL_PID
+    pid = os.getpid()
+    if _POOL is not None and _POOL_PID == pid:
+        return _POOL
+    with _POOL_LOCK:
+        if _POOL is None or _POOL_PID != pid:
+            config = CONFIG["POSTGRESQL"]
+            _POOL = ConnectionPool(
+                min_size=int(config.get("POOL_MIN_SIZE", 1)),
+                max_size=int(config.get("POOL_MAX_SIZE", 10)),
+                idle_timeout=float(config.get("POOL_IDLE_TIMEOUT", 300)),
+                timeout=float(config.get("POOL_TIMEOUT", 30)),
+                check_after=float(config.get("POOL_CHECK_AFTER", 5)),
+                **get_credentials()
+            )
+            _POOL_PID = pid
+        return _POOL
+
+
+def close_pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None and _POOL_PID == os.getpid():
+            _POOL.closeall()
+        _POOL = None
+
+
+# Stack of (transaction, savepoint) for the atomic() blocks entered in the current thread or task.
+_ATOMIC = ContextVar("sql_orm_atomic", default=())
+
+
+class Transaction:
+
+    def __init__(self, pool, connection):
+        self.pool = pool
+        self.connection = connection
+        self.savepoint_ids = itertools.count()
+        self.on_commit = []
+
+
+class Atomic(contextlib.ContextDecorator):
+
+    # Per-call state is kept in _ATOMIC, so one instance (e.g. a decorator) can be used by several threads or tasks.
+
+    def __init__(self, pool=None):
+        self.__pool = pool
+
+    @staticmethod
+    def __execute(connection, sql):
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+
+    def __enter__(self):
+        frames = _ATOMIC.get()
+        transaction = get_transaction()
+        if transaction is None or (self.__pool is not None and self.__pool is not transaction.pool):
+            pool = self.__pool if self.__pool is not None else get_pool()
+            transaction = Transaction(pool, pool.getconn())
+            savepoint = None
+        else:
+            savepoint = "sql_orm_savepoint_{}".format(next(transaction.savepoint_ids))
+            self.__execute(transaction.connection, "SAVEPOINT {};".format(savepoint))
+        _ATOMIC.set(frames + ((transaction, savepoint), ))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        frames = _ATOMIC.get()
+        transaction, savepoint = frames[-1]
+        _ATOMIC.set(frames[:-1])
+        connection = transaction.connection
+        if savepoint is not None:
+            if exc_type is None:
+                self.__execute(connection, "RELEASE SAVEPOINT {};".format(savepoint))
+            else:
+                self.__execute(connection, "ROLLBACK TO SAVEPOINT {};".format(savepoint))
+            return False
+        try:
+            if exc_type is None:
+                connection.commit()
+            else:
+                connection.rollback()
+        finally:
+            transaction.pool.putconn(connection)
+        if exc_type is None:
+            for callback in transaction.on_commit:
+                callback()
+        return False
+
+
+def atomic(pool=None):
+    return Atomic(pool=pool)
+
+
+def get_transaction():
+    frames = _ATOMIC.get()
+    return frames[-1][0] if frames else None
+
+
+class PostgreSQL:
+
+    def __init__(self, pool=None, prepare=None):
+        self._conn = None
+        self._cursor = None
+        config = CONFIG["POSTGRESQL"]
+        self.debug = config.get("DEBUG") == "True"
+        transaction = get_transaction()
+        # Inside atomic() every query runs on the connection pinned by the outermost block.
+        self._pinned = transaction is not None and (pool is None or pool is transaction.pool)
+        if self._pinned:
+            self._pool = transaction.pool
+            self._conn = transaction.connection
+        else:
+            self._pool = pool if pool is not None else get_pool()
+            self._conn = self._pool.getconn()
+        try:
+            self._cursor = self._conn.cursor()
+        except BaseException:
+            self.close()
+            raise
+        if prepare is None:
+            prepare = config.get("PREPARED_STATEMENTS") == "True"
+        self.prepared_statements = None
+        if prepare and isinstance(self._conn, PooledConnection):
+            if self._conn.prepared_statements is None:
+                self._conn.prepared_statements = PreparedStatements(
+                    threshold=int(config.get("PREPARE_THRESHOLD", 5)),
+                    max_size=int(config.get("MAX_PREPARED_STATEMENTS", 100))
+                )
+            self.prepared_statements = self._conn.prepared_statements
+        if self.debug and not self._pinned:
+            print("\nBorrowed PostgreSQL connection from the pool\n")
+
     def __enter__(self):
         return self
 
@@ -34,9 +405,16 @@ class PostgreSQL:
         self.close()
 
     def close(self):
-        self.connection.close()
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        if self._cursor is not None and not conn.closed:
+            self._cursor.close()
+        if self._pinned:
+            return
+        self._pool.putconn(conn)
         if self.debug:
-            print("\nClosed PostgreSQL connection.\n")
+            print("\nReturned PostgreSQL connection to the pool.\n")
 
     @property
     def connection(self):
@@ -47,12 +425,70 @@ class PostgreSQL:
         return self._cursor
 
     def commit(self):
-        self.connection.commit()
+        # Inside atomic() the outermost block commits.
+        if not self._pinned:
+            self.connection.commit()
 
-    def query(self, sql, params=None):
+    def __timed(self, sql, params, run):
+        event = instrumentation.start(sql, params)
+        if event is None:
+            return run()
+        instrumentation.before_execute(event)
+        start = time.perf_counter()
+        try:
+            return run()
+        except Exception as error:
+            event.error = error
+            raise
+        finally:
+            event.execute_time = time.perf_counter() - start
+            event.rows = max(self.cursor.rowcount, 0)
+            instrumentation.finish(event)
+
+    def __execute(self, sql, params=None, event=None):
         if self.debug:
-            print(self.mogrify(sql, params))
-        self.cursor.execute(sql, params or ())
+            print(sql, params or ())
+        params = params or ()
+        if event is None:
+            self.__timed(sql, params, lambda: self.__run(sql, params))
+            return
+        instrumentation.before_execute(event)
+        start = time.perf_counter()
+        try:
+            self.__run(sql, params)
+        except Exception as error:
+            event.error = error
+            raise
+        finally:
+            event.execute_time += time.perf_counter() - start
+
+    def __run(self, sql, params):
+        if self.prepared_statements is None:
+            self.cursor.execute(sql, params)
+            return
+        in_transaction = (
+            self._pinned or
+            self.connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        )
+        name = self.prepared_statements.name_for(self.cursor, sql)
+        if name is None:
+            self.cursor.execute(sql, params)
+            return
+        try:
+            if params:
+                self.cursor.execute("EXECUTE {}({});".format(name, ", ".join(["%s"] * len(params))), params)
+            else:
+                self.cursor.execute("EXECUTE {};".format(name))
+        except psycopg2.errors.InvalidSqlStatementName:
+            # The server side statements are gone (e.g. DISCARD ALL or a proxy reset the session).
+            self.prepared_statements.reset()
+            if in_transaction:
+                raise
+            self.connection.rollback()
+            self.cursor.execute(sql, params)
+
+    def query(self, sql, params=None):
+        self.__execute(sql, params)
 
     def mogrify(self, sql, params=None):
         return self.cursor.mogrify(sql, params or ())
@@ -64,28 +500,73 @@ class PostgreSQL:
         return self.cursor.fetchone()
 
     def insert(self, sql, params=None):
-        if self.debug:
-            print(self.mogrify(sql, params))
-        self.cursor.execute(sql, params or ())
+        self.__execute(sql, params)
         self.commit()
 
     def insert_many(self, sql, params=None):
         params_str = ','.join((self.mogrify("%s", (x, ))).decode('utf-8') for x in params)
         if self.debug:
-            print(self.mogrify(sql.format(params_str)))
-        self.cursor.execute(sql.format(params_str))
+            print(sql.format(params_str))
+        self.__timed(sql, params, lambda: self.cursor.execute(sql.format(params_str)))
         self.commit()
 
-    def fetch_query_results(self, sql, params=None):
+    def copy_rows(self, table_name, columns, rows):
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write("\t".join([copy_text_value(value) for value in row]))
+            buffer.write("\n")
+        buffer.seek(0)
+        sql = "COPY {} ({}) FROM STDIN WITH (FORMAT text)".format(table_name, ", ".join(columns))
         if self.debug:
-            print(self.mogrify(sql, params))
-        self.cursor.execute(sql, params or ())
+            print(sql)
+        self.__timed(sql, rows, lambda: self.cursor.copy_expert(sql, buffer))
+
+    def execute_values(self, sql, rows, template=None):
+        if self.debug:
+            print(sql)
+        self.__timed(sql, rows, lambda: psycopg2.extras.execute_values(
+            self.cursor, sql, rows, template=template, page_size=max(len(rows), 1)))
+        return self.cursor.rowcount
+
+    def insert_returning(self, sql, rows, template=None):
+        if self.debug:
+            print(sql)
+        return self.__timed(sql, rows, lambda: psycopg2.extras.execute_values(
+            self.cursor, sql, rows, template=template, page_size=max(len(rows), 1), fetch=True))
+
+    def fetch_query_results(self, sql, params=None, event=None):
+        self.__execute(sql, params, event=event)
         while True:
+            start = time.perf_counter()
             try:
                 results = self.cursor.fetchmany(100)
+            except psycopg2.ProgrammingError:
+                break
+            if event is not None:
+                event.fetch_time += time.perf_counter() - start
+            if not results:
+                break
+            for result in results:
+                yield result
+
+    def stream_query_results(self, sql, params=None, chunk_size=2000, event=None):
+        if self.debug:
+            print(sql, params or ())
+        name = "sql_orm_cursor_{}".format(next(_CURSOR_IDS))
+        with self.connection.cursor(name=name) as cursor:
+            cursor.itersize = chunk_size
+            if event is not None:
+                instrumentation.before_execute(event)
+            start = time.perf_counter()
+            cursor.execute(sql, params or ())
+            if event is not None:
+                event.execute_time += time.perf_counter() - start
+            while True:
+                start = time.perf_counter()
+                results = cursor.fetchmany(chunk_size)
+                if event is not None:
+                    event.fetch_time += time.perf_counter() - start
                 if not results:
                     break
                 for result in results:
                     yield result
-            except psycopg2.ProgrammingError:
-                break
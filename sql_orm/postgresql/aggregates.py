@@ -0,0 +1,45 @@
+class Aggregate:
+
+    function = None
+
+    def __init__(self, field, distinct=False):
+        self.field = field
+        self.distinct = distinct
+
+    def __repr__(self):
+        return "{}({!r})".format(self.__class__.__name__, self.field)
+
+    @property
+    def shape(self):
+        return self.function, self.field, self.distinct
+
+    def as_sql(self, column):
+        return "{}({}{})".format(self.function, "DISTINCT " if self.distinct else "", column)
+
+
+class Sum(Aggregate):
+
+    function = "SUM"
+
+
+class Avg(Aggregate):
+
+    function = "AVG"
+
+
+class Min(Aggregate):
+
+    function = "MIN"
+
+
+class Max(Aggregate):
+
+    function = "MAX"
+
+
+class Count(Aggregate):
+
+    function = "COUNT"
+
+    def __init__(self, field="*", distinct=False):
+        super().__init__(field, distinct=distinct)
@@ -0,0 +1,422 @@
+import asyncio
+import itertools
+import time
+import weakref
+
+import psycopg2
+import psycopg2.extensions
+
+from sql_orm.postgresql import CONFIG, PoolException, get_credentials
+from sql_orm.postgresql import cache
+from sql_orm.postgresql import instrumentation
+from sql_orm.postgresql.objects import (
+    RowSet, QueryException, ObjectDoesNotExist, MultipleObjectsFound, batched, UPSERT_ATTEMPTS
+)
+
+
+async def _wait_fd(fd, add, remove):
+    future = asyncio.get_running_loop().create_future()
+    add(fd, lambda: future.done() or future.set_result(None))
+    try:
+        await future
+    finally:
+        remove(fd)
+
+
+async def wait(conn):
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        if state == psycopg2.extensions.POLL_READ:
+            await _wait_fd(conn.fileno(), loop.add_reader, loop.remove_reader)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            await _wait_fd(conn.fileno(), loop.add_writer, loop.remove_writer)
+        else:
+            raise psycopg2.OperationalError("Unexpected poll() state: {}".format(state))
+
+
+class AsyncConnectionPool:
+
+    def __init__(self, max_size=10, idle_timeout=300, timeout=30, **credentials):
+        if max_size < 1:
+            raise PoolException("Invalid pool size. Expected max_size >= 1.")
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.__credentials = credentials
+        self.__idle = []
+        self.__in_use = 0
+        self.__closed = False
+        self.__condition = asyncio.Condition()
+
+    async def __connect(self):
+        try:
+            conn = psycopg2.connect(async_=True, **self.__credentials)
+            await wait(conn)
+        except psycopg2.Error as error:
+            raise ValueError("Unable to connect to PostgreSQL database\n{error}".format(error=error))
+        return conn
+
+    @staticmethod
+    def __close_connection(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def __prune_idle(self):
+        now = time.monotonic()
+        while self.__idle and now - self.__idle[0][1] > self.idle_timeout:
+            self.__close_connection(self.__idle.pop(0)[0])
+
+    @property
+    def size(self):
+        return len(self.__idle) + self.__in_use
+
+    @property
+    def idle(self):
+        return len(self.__idle)
+
+    async def getconn(self):
+        async with self.__condition:
+            def available():
+                return self.__closed or self.__idle or len(self.__idle) + self.__in_use < self.max_size
+            try:
+                await asyncio.wait_for(self.__condition.wait_for(available), self.timeout)
+            except asyncio.TimeoutError:
+                raise PoolException("Timed out waiting for a PostgreSQL connection from the pool.")
+            if self.__closed:
+                raise PoolException("The connection pool is closed.")
+            self.__prune_idle()
+            conn = self.__idle.pop()[0] if self.__idle else None
+            self.__in_use += 1
+        if conn is not None and not conn.closed:
+            return conn
+        try:
+            return await self.__connect()
+        except BaseException:
+            async with self.__condition:
+                self.__in_use -= 1
+                self.__condition.notify()
+            raise
+
+    async def putconn(self, conn, discard=False):
+        async with self.__condition:
+            self.__in_use -= 1
+            # A connection given back in the middle of a query or a transaction (e.g. a cancelled task) cannot be reused.
+            if (discard or conn.closed or conn.isexecuting() or self.__closed or
+                    conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+                self.__close_connection(conn)
+            else:
+                self.__idle.append((conn, time.monotonic()))
+            self.__condition.notify()
+
+    async def closeall(self):
+        async with self.__condition:
+            self.__closed = True
+            while self.__idle:
+                self.__close_connection(self.__idle.pop()[0])
+            self.__condition.notify_all()
+
+
+_POOLS = weakref.WeakKeyDictionary()
+
+
+def get_pool():
+    # asyncio primitives belong to one event loop, so every loop gets its own pool.
+    loop = asyncio.get_running_loop()
+    pool = _POOLS.get(loop)
+    if pool is None:
+        config = CONFIG["POSTGRESQL"]
+        pool = _POOLS[loop] = AsyncConnectionPool(
+            max_size=int(config.get("POOL_MAX_SIZE", 10)),
+            idle_timeout=float(config.get("POOL_IDLE_TIMEOUT", 300)),
+            timeout=float(config.get("POOL_TIMEOUT", 30)),
+            **get_credentials()
+        )
+    return pool
+
+
+async def close_pool():
+    pool = _POOLS.pop(asyncio.get_running_loop(), None)
+    if pool is not None:
+        await pool.closeall()
+
+
+class AsyncPostgreSQL:
+
+    def __init__(self, pool=None):
+        self.debug = CONFIG["POSTGRESQL"].get("DEBUG") == "True"
+        self._pool = pool
+        self._conn = None
+        self._cursor = None
+
+    async def __aenter__(self):
+        if self._pool is None:
+            self._pool = get_pool()
+        self._conn = await self._pool.getconn()
+        self._cursor = self._conn.cursor()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        if not conn.closed and not conn.isexecuting():
+            self._cursor.close()
+        await self._pool.putconn(conn)
+
+    @property
+    def connection(self):
+        return self._conn
+
+    @property
+    def cursor(self):
+        return self._cursor
+
+    def mogrify(self, sql, params=None):
+        return self.cursor.mogrify(sql, params or ())
+
+    async def query(self, sql, params=None):
+        if self.debug:
+            print(sql, params)
+        event = instrumentation.start(sql, params)
+        if event is None:
+            self.cursor.execute(sql, params)
+            await wait(self.connection)
+            return
+        instrumentation.before_execute(event)
+        start = time.perf_counter()
+        try:
+            self.cursor.execute(sql, params)
+            await wait(self.connection)
+        except Exception as error:
+            event.error = error
+            raise
+        finally:
+            event.execute_time = time.perf_counter() - start
+            event.rows = max(self.cursor.rowcount, 0)
+            instrumentation.finish(event)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+
+_CURSOR_IDS = itertools.count()
+
+
+class AsyncRowSet(RowSet):
+    # Query building is inherited from RowSet, only the methods touching the database are coroutines;
+    # the synchronous ones without an async version raise instead of blocking the event loop. Sessions and
+    # the Seq Scan check run blocking queries, async queries skip them.
+    # Async connections are always in autocommit mode. Lazy foreign keys and deferred columns still
+    # load through the synchronous connection, select_related() avoids that.
+
+    def __init__(self, table_class):
+        super().__init__(table_class)
+        self._table_class = table_class
+
+    def __iter__(self):
+        raise TypeError("Use 'async for' to iterate an AsyncRowSet.")
+
+    def iterator(self, chunk_size=2000):
+        raise TypeError("Use 'async for' to iterate an AsyncRowSet.")
+
+    def __next__(self):
+        raise TypeError("Use 'async for' to iterate an AsyncRowSet.")
+
+    def __getitem__(self, index):
+        if isinstance(index, int):
+            raise TypeError("Indexing an AsyncRowSet is not supported, slice it and await first().")
+        return super().__getitem__(index)
+
+    def prefetch_related(self, *args):
+        raise QueryException("prefetch_related is not supported on async queries.")
+
+    def __unsupported(self, name):
+        raise QueryException("{} is not supported on async queries.".format(name))
+
+    def bulk_update(self, obj_list, fields, batch_size=1000):
+        self.__unsupported("bulk_update")
+
+    def bulk_upsert(self, obj_list, conflict_fields=None, update_fields=None, batch_size=1000):
+        self.__unsupported("bulk_upsert")
+
+    def paginate_by_key(self, order_by, after=None, page_size=100):
+        self.__unsupported("paginate_by_key")
+
+    def explain(self, analyze=False, buffers=False, format="json"):
+        self.__unsupported("explain")
+
+    async def __fetchall(self, query, params=()):
+        async with AsyncPostgreSQL() as pgsql:
+            await pgsql.query(query, params=params)
+            return pgsql.fetchall()
+
+    async def __execute(self, query, params=()):
+        async with AsyncPostgreSQL() as pgsql:
+            await pgsql.query(query, params=params)
+            return pgsql.cursor.rowcount
+
+    def _create_query(self, count=False, exists=False, update=None, aggregate=None, delete=False):
+        return self._compile_query(count=count, exists=exists, update=update, aggregate=aggregate, delete=delete)
+
+    async def __fetch_objects(self):
+        return list(self._decode_rows(await self.__fetchall(**self._create_query())))
+
+    def __aiter__(self):
+        return self.aiterator()
+
+    async def aiterator(self, chunk_size=2000):
+        # Async connections cannot open named cursors, the server-side cursor is declared by hand.
+        if chunk_size < 1:
+            raise ValueError("chunk_size should be a positive integer.")
+        query = self._create_query()
+        name = "sql_orm_cursor_{}".format(next(_CURSOR_IDS))
+        async with AsyncPostgreSQL() as pgsql:
+            await pgsql.query("BEGIN;")
+            try:
+                await pgsql.query(
+                    "DECLARE {} NO SCROLL CURSOR FOR {}".format(name, query["query"].rstrip(";")),
+                    params=query["params"]
+                )
+                while True:
+                    await pgsql.query("FETCH {} FROM {};".format(chunk_size, name))
+                    rows = pgsql.fetchall()
+                    for obj in self._decode_rows(rows, batch_size=chunk_size):
+                        yield obj
+                    if len(rows) < chunk_size:
+                        break
+            finally:
+                if not pgsql.connection.closed and not pgsql.connection.isexecuting():
+                    await pgsql.query("ROLLBACK;")
+
+    async def get(self, **kwargs):
+        objects_found = await self.filter(**kwargs)[:2].__fetch_objects()
+        if not objects_found:
+            raise ObjectDoesNotExist("Object does not exist.")
+        if len(objects_found) > 1:
+            raise MultipleObjectsFound("Multiple objects found.")
+        return objects_found[0]
+
+    async def get_or_none(self, **kwargs):
+        try:
+            return await self.get(**kwargs)
+        except (ObjectDoesNotExist, MultipleObjectsFound):
+            return None
+
+    async def __insert_on_conflict(self, kwargs, defaults, conflict_fields, update):
+        query = self._upsert_query(kwargs, defaults, conflict_fields, update)
+        row = None
+        async with AsyncPostgreSQL() as pgsql:
+            for _ in range(UPSERT_ATTEMPTS):
+                await pgsql.query(query["query"], params=query["params"])
+                row = pgsql.fetchone()
+                if row is not None:
+                    break
+        cache.invalidate(self._table_class)
+        return self._upserted_object(row)
+
+    async def get_or_create(self, defaults=None, **kwargs):
+        defaults = defaults if defaults else {}
+        conflict_fields = self._conflict_fields(kwargs)
+        if conflict_fields:
+            return await self.__insert_on_conflict(kwargs, defaults, conflict_fields, update=False)
+        try:
+            return await self.get(**kwargs), False
+        except ObjectDoesNotExist:
+            return await self.create(**dict(kwargs, **defaults)), True
+
+    async def update_or_create(self, defaults=None, **kwargs):
+        defaults = defaults if defaults else {}
+        conflict_fields = self._conflict_fields(kwargs)
+        if conflict_fields:
+            return await self.__insert_on_conflict(kwargs, defaults, conflict_fields, update=True)
+        try:
+            obj = await self.get(**kwargs)
+        except ObjectDoesNotExist:
+            return await self.create(**dict(kwargs, **defaults)), True
+        for k, v in defaults.items():
+            setattr(obj, k, v)
+        await obj.asave()
+        return obj, False
+
+    async def first(self):
+        objects_found = await self[:1].__fetch_objects()
+        return objects_found[0] if objects_found else None
+
+    async def last(self):
+        self._reverse_ordering()
+        return await self.first()
+
+    async def aggregate(self, **kwargs):
+        query = self._aggregate_query(kwargs)
+        if query is None:
+            return {}
+        rows = await self.__fetchall(**query)
+        return dict(zip(kwargs, rows[0]))
+
+    async def count(self):
+        rows = await self.__fetchall(**self._create_query(count=True))
+        return rows[0][0]
+
+    async def exists(self):
+        return bool(await self.__fetchall(**self._create_query(exists=True)))
+
+    async def create(self, **kwargs):
+        obj = self._table_class(**kwargs)
+        await obj.asave()
+        return obj
+
+    async def bulk_create(self, obj_list, batch_size=1000):
+        if batch_size < 1:
+            raise ValueError("batch_size should be a positive integer.")
+        meta = self._table_class._meta
+        column_names = [i for i in meta.column_names if i != "id"]
+        query = "INSERT INTO {} ({}) VALUES {{}} RETURNING id;".format(
+            self._table_class.get_full_table_name(),
+            ", ".join([meta.quoted_column_names[i] for i in column_names])
+        )
+        template = "({})".format(", ".join(["%s"] * len(column_names)))
+        ids = []
+        async with AsyncPostgreSQL() as pgsql:
+            for batch in batched(obj_list, batch_size):
+                values = b",".join([pgsql.mogrify(template, self._bulk_row(obj, column_names)) for obj in batch])
+                await pgsql.query(query.format(values.decode()))
+                batch_ids = [i[0] for i in pgsql.fetchall()]
+                for obj, obj_id in zip(batch, batch_ids):
+                    if isinstance(obj, dict):
+                        obj["id"] = obj_id
+                    else:
+                        obj.__dict__["id"] = obj_id
+                        obj._clear_dirty_fields()
+                ids.extend(batch_ids)
+        cache.invalidate(self._table_class)
+        return ids
+
+    async def update(self, **kwargs):
+        query = self._update_query(kwargs)
+        if query is None:
+            return 0
+        rowcount = await self.__execute(**query)
+        cache.invalidate(self._table_class)
+        return rowcount
+
+    async def delete(self):
+        rowcount = await self.__execute(**self._create_query(delete=True))
+        cache.invalidate(self._table_class)
+        return rowcount
+
+
+class AsyncObjects:
+
+    def __get__(self, instance, owner):
+        return AsyncRowSet(table_class=owner)
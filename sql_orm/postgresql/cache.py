@@ -0,0 +1,143 @@
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from sql_orm import postgresql
+
+
+class CacheBackend:
+    # Interface for result cache backends. Rows are lists of tuples, tables are full table names (schema.table).
+    # Every invalidation moves the generation of its tables; set() is given the generations read before the
+    # query ran and must not store the rows if any of them moved, since they may predate a concurrent write.
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def generations(self, tables):
+        raise NotImplementedError
+
+    def set(self, key, rows, ttl, tables, generations):
+        raise NotImplementedError
+
+    def invalidate(self, tables):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class LRUCacheBackend(CacheBackend):
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__keys_by_table = {}
+        self.__generations = {}
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __remove(self, key):
+        _, tables, _ = self.__entries.pop(key)
+        for table in tables:
+            keys = self.__keys_by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.__keys_by_table[table]
+
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= time.monotonic():
+                self.__remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.__entries.move_to_end(key)
+            return entry[2]
+
+    def __current_generations(self, tables):
+        return tuple(self.__generations.get(i, 0) for i in tables)
+
+    def generations(self, tables):
+        with self.__lock:
+            return self.__current_generations(tables)
+
+    def set(self, key, rows, ttl, tables, generations):
+        expires = time.monotonic() + ttl if ttl is not None else None
+        tables = tuple(tables)
+        with self.__lock:
+            if self.__current_generations(tables) != tuple(generations):
+                return
+            if key in self.__entries:
+                self.__remove(key)
+            self.__entries[key] = (expires, tables, rows)
+            for table in tables:
+                self.__keys_by_table.setdefault(table, set()).add(key)
+            while len(self.__entries) > self.maxsize:
+                self.__remove(next(iter(self.__entries)))
+
+    def invalidate(self, tables):
+        with self.__lock:
+            for table in tables:
+                self.__generations[table] = self.__generations.get(table, 0) + 1
+                for key in list(self.__keys_by_table.get(table, ())):
+                    self.__remove(key)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__keys_by_table.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.__entries),
+                "maxsize": self.maxsize
+            }
+
+
+_BACKEND = None
+_PENDING_INVALIDATIONS = weakref.WeakKeyDictionary()
+
+
+def get_backend():
+    global _BACKEND
+    if _BACKEND is None:
+        _BACKEND = LRUCacheBackend(
+            maxsize=int(postgresql.CONFIG.get("POSTGRESQL", "RESULT_CACHE_SIZE", fallback=1024)))
+    return _BACKEND
+
+
+def set_backend(backend):
+    global _BACKEND
+    _BACKEND = backend
+
+
+def make_key(sql, params):
+    return "{}\x1f{!r}".format(sql, tuple(params))
+
+
+def invalidate(*table_classes):
+    tables = {i.get_full_table_name() for i in table_classes}
+    get_backend().invalidate(tables)
+    transaction = postgresql.get_transaction()
+    if transaction is None:
+        return
+    # Readers outside the transaction may cache the old rows again until it commits.
+    pending = _PENDING_INVALIDATIONS.get(transaction)
+    if pending is None:
+        pending = _PENDING_INVALIDATIONS[transaction] = set()
+        transaction.on_commit.append(lambda: get_backend().invalidate(_PENDING_INVALIDATIONS.pop(transaction, ())))
+    pending.update(tables)
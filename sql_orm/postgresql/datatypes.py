@@ -1,4 +1,4 @@
-from sql_orm import DATABASE_TYPES, BaseField
+from sql_orm import DATABASE_TYPES, BaseField, get_identity_map
 from sql_orm.postgresql import sql
 
 
@@ -11,6 +11,7 @@ class Field(BaseField):
         self.__value = None
         self.verbose_name = verbose_name
         self.primary_key = primary_key
+        self.null = null and not primary_key
         if primary_key:
             self.properties = "PRIMARY KEY"
         else:
@@ -31,6 +32,10 @@ class Field(BaseField):
     def convert(value):
         return value
 
+    @property
+    def cast_type(self):
+        return "INTEGER" if self.field_type == "SERIAL" else self.field_type
+
     def create(self, schema, table_name, column_name):
         query = self.base_create_query.format(
             schema=schema,
@@ -44,6 +49,9 @@ class Field(BaseField):
     def set_value(self, value):
         self.__value = value
 
+    def get_value(self):
+        return self.__value
+
 
 class BooleanField(Field):
 
@@ -109,10 +117,12 @@ class CharField(Field):
 
 class ForeignKeyField(Field):
 
+    is_relation = True
+
     def __init__(self, table_name, verbose_name=None, null=False, unique=False):
-        pk = table_name.get_pk_name()
+        pk = table_name._meta.pk_name
         self.table_name = table_name
-        self.field = table_name.__dict__[pk]
+        self.field = table_name._meta.fields[pk]
         extra_sql = "REFERENCES {schema}.{table_name}({pk})".format(
             schema=table_name.get_schema(),
             table_name=table_name.get_table_name(),
@@ -121,8 +131,34 @@ class ForeignKeyField(Field):
         self.field_type = "INTEGER" if self.field.field_type == "SERIAL" else self.field.field_type
         super().__init__(verbose_name=verbose_name, null=null, unique=unique, extra_sql=(extra_sql, ))
 
+    def bind(self, value):
+        field = object.__new__(self.__class__)
+        field.__dict__.update(self.__dict__)
+        field.set_value(value)
+        return field
+
+    def set_value(self, value):
+        super().set_value(value)
+        self.__dict__.pop("_ForeignKeyField__instance", None)
+
+    def get_related_object(self):
+        attributes = self.__dict__
+        instance = attributes.get("_ForeignKeyField__instance")
+        if instance is None:
+            table_class = attributes["table_name"]
+            value = attributes["_Field__value"]
+            identities = get_identity_map()
+            if identities is not None:
+                instance = identities.get(table_class, value)
+            if instance is None:
+                instance = table_class.objects.get(pk=value)
+                if identities is not None:
+                    instance = identities.add(instance)
+            attributes["_ForeignKeyField__instance"] = instance
+        return instance
+
     def __getattribute__(self, item):
         try:
             return object.__getattribute__(self, item)
         except AttributeError:
-            return getattr(self.__dict__["table_name"].objects.get(pk=self.__dict__["_Field__value"]), item)
+            return getattr(self.get_related_object(), item)
@@ -0,0 +1,188 @@
+import logging
+import threading
+import time
+from collections import deque
+
+
+SLOW_QUERY_LOGGER = logging.getLogger("sql_orm.slow_queries")
+
+_BEFORE_EXECUTE_HOOKS = []
+_AFTER_EXECUTE_HOOKS = []
+_SETTINGS = {"slow_query_threshold": None}
+
+
+class QueryEvent:
+
+    __slots__ = (
+        "sql", "params_count", "rows", "compile_time", "execute_time", "fetch_time", "hydrate_time", "error"
+    )
+
+    def __init__(self, sql=None, params=None):
+        self.sql = sql
+        self.params_count = len(params) if params else 0
+        self.rows = 0
+        self.compile_time = 0.0
+        self.execute_time = 0.0
+        self.fetch_time = 0.0
+        self.hydrate_time = 0.0
+        self.error = None
+
+    @property
+    def total_time(self):
+        return self.compile_time + self.execute_time + self.fetch_time + self.hydrate_time
+
+    def as_dict(self):
+        return {
+            "sql": self.sql,
+            "params_count": self.params_count,
+            "rows": self.rows,
+            "compile_time": self.compile_time,
+            "execute_time": self.execute_time,
+            "fetch_time": self.fetch_time,
+            "hydrate_time": self.hydrate_time,
+            "total_time": self.total_time,
+            "error": repr(self.error) if self.error is not None else None
+        }
+
+
+class QueryStats:
+
+    def __init__(self, sample_size=1000):
+        self.enabled = False
+        self.sample_size = sample_size
+        self.__shapes = {}
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__shapes)
+
+    def record(self, event):
+        with self.__lock:
+            entry = self.__shapes.get(event.sql)
+            if entry is None:
+                entry = self.__shapes[event.sql] = {
+                    "count": 0,
+                    "errors": 0,
+                    "rows": 0,
+                    "total_time": 0.0,
+                    "samples": deque(maxlen=self.sample_size)
+                }
+            entry["count"] += 1
+            entry["errors"] += event.error is not None
+            entry["rows"] += event.rows
+            entry["total_time"] += event.total_time
+            entry["samples"].append(event.total_time)
+
+    @staticmethod
+    def __percentile(samples, fraction):
+        return samples[min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))]
+
+    def snapshot(self):
+        with self.__lock:
+            shapes = {k: dict(v, samples=sorted(v["samples"])) for k, v in self.__shapes.items()}
+        for entry in shapes.values():
+            samples = entry.pop("samples")
+            entry["mean"] = entry["total_time"] / entry["count"]
+            entry["p50"] = self.__percentile(samples, 0.5)
+            entry["p99"] = self.__percentile(samples, 0.99)
+            entry["max"] = samples[-1]
+        return shapes
+
+    def clear(self):
+        with self.__lock:
+            self.__shapes.clear()
+
+
+STATS = QueryStats()
+
+
+def configure(slow_query_threshold=None, collect_stats=False):
+    set_slow_query_threshold(slow_query_threshold)
+    STATS.enabled = collect_stats
+
+
+def set_slow_query_threshold(seconds):
+    _SETTINGS["slow_query_threshold"] = float(seconds) if seconds is not None else None
+
+
+def add_before_execute_hook(hook):
+    _BEFORE_EXECUTE_HOOKS.append(hook)
+
+
+def add_after_execute_hook(hook):
+    _AFTER_EXECUTE_HOOKS.append(hook)
+
+
+def remove_hook(hook):
+    for hooks in (_BEFORE_EXECUTE_HOOKS, _AFTER_EXECUTE_HOOKS):
+        while hook in hooks:
+            hooks.remove(hook)
+
+
+def enable_stats(sample_size=None):
+    if sample_size is not None:
+        STATS.sample_size = sample_size
+    STATS.enabled = True
+
+
+def disable_stats():
+    STATS.enabled = False
+
+
+def get_stats():
+    return STATS.snapshot()
+
+
+def enabled():
+    return bool(
+        _BEFORE_EXECUTE_HOOKS or
+        _AFTER_EXECUTE_HOOKS or
+        STATS.enabled or
+        _SETTINGS["slow_query_threshold"] is not None
+    )
+
+
+def start(sql=None, params=None):
+    return QueryEvent(sql, params) if enabled() else None
+
+
+def before_execute(event):
+    for hook in _BEFORE_EXECUTE_HOOKS:
+        hook(event)
+
+
+def finish(event):
+    if STATS.enabled:
+        STATS.record(event)
+    threshold = _SETTINGS["slow_query_threshold"]
+    if threshold is not None and event.total_time >= threshold:
+        SLOW_QUERY_LOGGER.warning(
+            "Slow query (%.1f ms: compile %.1f, execute %.1f, fetch %.1f, hydrate %.1f; %d rows): %s",
+            event.total_time * 1000, event.compile_time * 1000, event.execute_time * 1000,
+            event.fetch_time * 1000, event.hydrate_time * 1000, event.rows, event.sql
+        )
+    for hook in _AFTER_EXECUTE_HOOKS:
+        hook(event)
+
+
+def instrument_rows(event, objects):
+    # Time spent inside the row generator is execute + fetch + hydrate; the consumer's own work is not counted.
+    elapsed = 0.0
+    try:
+        iterator = iter(objects)
+        while True:
+            begin = time.perf_counter()
+            try:
+                obj = next(iterator)
+            except StopIteration:
+                elapsed += time.perf_counter() - begin
+                break
+            elapsed += time.perf_counter() - begin
+            event.rows += 1
+            yield obj
+    except Exception as error:
+        event.error = error
+        raise
+    finally:
+        event.hydrate_time = max(elapsed - event.execute_time - event.fetch_time, 0.0)
+        finish(event)
@@ -1,8 +1,17 @@
-from sql_orm import postgresql
+from sql_orm import postgresql, Table, get_identity_map
 from sql_orm.postgresql import sql
 from sql_orm.postgresql import datatypes
-from collections import OrderedDict
-from copy import deepcopy
+from sql_orm.postgresql import instrumentation
+from sql_orm.postgresql import cache
+from sql_orm.postgresql import plans
+from sql_orm.postgresql.aggregates import Aggregate
+from sql_orm.postgresql.session import get_session
+import base64
+import binascii
+import itertools
+import json
+import time
+import weakref
 
 
 class QueryException(Exception):
@@ -17,12 +26,191 @@ class MultipleObjectsFound(Exception):
     pass
 
 
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+PREFETCH_BATCH_SIZE = 1000
+UPSERT_ATTEMPTS = 3
+
+
+def encode_page_token(values):
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+
+def decode_page_token(token):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+    except (ValueError, binascii.Error):
+        raise QueryException("Invalid pagination token.")
+    if not isinstance(values, list):
+        raise QueryException("Invalid pagination token.")
+    return values
+
+
+def prefetch_related_objects(obj_list, *lookups):
+    if not obj_list:
+        return
+    for lookup in lookups:
+        current = obj_list
+        table_class = type(obj_list[0])
+        for fk in lookup.split(sql.LOGICAL_SEPARATOR):
+            if fk not in table_class._meta.foreign_keys:
+                raise QueryException("Foreign key not found: {}".format(fk))
+            related_class = table_class._meta.foreign_keys[fk].table_name
+            resolved = {}
+            pending = {}
+            for obj in current:
+                value = obj.__dict__.get(fk)
+                if isinstance(value, Table):
+                    resolved[id(value)] = value
+                    continue
+                if isinstance(value, datatypes.ForeignKeyField):
+                    value = value.get_value()
+                if value is not None:
+                    pending.setdefault(value, []).append(obj)
+            identities = get_identity_map()
+            if pending and identities is not None:
+                for value in list(pending):
+                    related_obj = identities.get(related_class, value)
+                    if related_obj is not None:
+                        for owner in pending.pop(value):
+                            owner.__dict__[fk] = related_obj
+                        resolved[id(related_obj)] = related_obj
+            if pending:
+                pk_name = related_class._meta.pk_name
+                lookup_key = "{}{}in".format(pk_name, sql.LOGICAL_SEPARATOR)
+                for related_obj in related_class.objects.filter(**{lookup_key: list(pending)}):
+                    if identities is not None:
+                        related_obj = identities.add(related_obj)
+                    for owner in pending.get(related_obj.__dict__[pk_name], ()):
+                        owner.__dict__[fk] = related_obj
+                    resolved[id(related_obj)] = related_obj
+            current = list(resolved.values())
+            table_class = related_class
+            if not current:
+                break
+
+
+class DeferredLoader:
+
+    def __init__(self, table_class, columns):
+        self.table_class = table_class
+        self.columns = tuple(columns)
+        self.__pending = {}
+
+    def add(self, obj):
+        pk = obj.__dict__.get(self.table_class._meta.pk_name)
+        if pk is not None:
+            self.__pending.setdefault(pk, []).append(weakref.ref(obj))
+        obj.__dict__["_deferred_loader"] = self
+
+    def load(self, obj):
+        meta = self.table_class._meta
+        pending, self.__pending = self.__pending, {}
+        targets = {}
+        for pk, refs in pending.items():
+            objects = [i for i in (ref() for ref in refs) if i is not None]
+            if objects:
+                targets[pk] = objects
+        pk = obj.__dict__.get(meta.pk_name)
+        if pk is not None and obj not in targets.get(pk, ()):
+            targets.setdefault(pk, []).append(obj)
+        obj.__dict__.pop("_deferred_loader", None)
+        if not targets:
+            return
+        lookup_key = "{}{}in".format(meta.pk_name, sql.LOGICAL_SEPARATOR)
+        rows = self.table_class.objects.filter(**{lookup_key: list(targets)}).values_list(meta.pk_name, *self.columns)
+        for row in rows:
+            for target in targets.get(row[0], ()):
+                for column, value in zip(self.columns, row[1:]):
+                    if column in meta.foreign_keys:
+                        value = meta.fields[column].bind(value)
+                    target.__dict__.setdefault(column, value)
+                target.__dict__.pop("_deferred_loader", None)
+
+
+class RowDecoder:
+
+    def __init__(self, table_class, base_table_proxy, table_details, columns_order, annotations=()):
+        self.__annotations = tuple(annotations)
+        positions = {column: index for index, column in enumerate(columns_order)}
+        joined = {}
+        for proxy, details in table_details.items():
+            joined.setdefault((details["parent_proxy"], details["details"]["key"]), proxy)
+        self.__plan = self.__compile(table_class, base_table_proxy, positions, joined)
+        self.has_deferred = self.__has_deferred(self.__plan)
+
+    @classmethod
+    def __has_deferred(cls, plan):
+        return bool(plan[5]) or any(cls.__has_deferred(i) for _, i in plan[4])
+
+    @classmethod
+    def __compile(cls, table_class, proxy, positions, joined):
+        values = []
+        foreign_keys = []
+        related = []
+        deferred = []
+        meta = table_class._meta
+        for column in meta.column_names:
+            field = meta.fields[column]
+            position = positions.get("{}.{}".format(proxy, column))
+            if column in meta.foreign_keys:
+                fk_proxy = joined.get((proxy, column))
+                if fk_proxy:
+                    related.append((column, cls.__compile(field.table_name, fk_proxy, positions, joined)))
+                elif position is None:
+                    deferred.append(column)
+                else:
+                    foreign_keys.append((column, position, field))
+            elif position is None:
+                deferred.append(column)
+            else:
+                values.append((column, position))
+        template = dict(table_class().__dict__)
+        for column in deferred:
+            del template[column]
+        return table_class, template, tuple(values), tuple(foreign_keys), tuple(related), tuple(deferred)
+
+    def __hydrate(self, plan, row, loaders):
+        table_class, template, values, foreign_keys, related, deferred = plan
+        obj = table_class.__new__(table_class)
+        attributes = obj.__dict__
+        attributes.update(template)
+        attributes["_dirty_fields"] = set()
+        for column, index in values:
+            attributes[column] = row[index]
+        for column, index, field in foreign_keys:
+            attributes[column] = field.bind(row[index])
+        for column, related_plan in related:
+            attributes[column] = self.__hydrate(related_plan, row, loaders)
+        if deferred:
+            if loaders is None:
+                loader = DeferredLoader(table_class, deferred)
+            else:
+                loader = loaders.get((table_class, deferred))
+                if loader is None:
+                    loader = loaders[(table_class, deferred)] = DeferredLoader(table_class, deferred)
+            loader.add(obj)
+        return obj
+
+    def decode(self, row, loaders=None):
+        obj = self.__hydrate(self.__plan, row, loaders)
+        if self.__annotations:
+            obj.__dict__.update(zip(self.__annotations, row[-len(self.__annotations):]))
+        return obj
+
+
 class RowSet:
 
     def __init__(self, table_class):
-        self.pgsql = postgresql.PostgreSQL()
         self.__table_class = table_class
-        self.__table_columns = table_class.get_column_names()
+        self.__table_columns = table_class._meta.column_names
         self.__filter_exclude_inputs = {
             "filter": {},
             "or_filter": {},
@@ -31,12 +219,18 @@ class RowSet:
         }
         self.__limit = None
         self.__offset = None
-        self.__delete = False
         self.__select_related = []
-        self.__columns_order = []
-        self.__value = None
+        self.__prefetch_related = []
+        self.__values_fields = []
+        self.__values_mode = None
+        self.__only_fields = []
+        self.__deferred_fields = []
+        self.__annotations = {}
+        self.__after = None
+        self.__row_decoder = None
         self.__table_details = None
         self.__base_table_proxy = None
+        self.__cache_ttl = None
 
     @staticmethod
     def get_details_from_table_proxy(proxy):
@@ -48,31 +242,92 @@ class RowSet:
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
-    def __del__(self):
-        self.close()
-
     def close(self):
-        self.pgsql.close()
+        # Connections are borrowed from the pool per operation, nothing is held between queries.
+        pass
+
+    def __sql_read(self, query, params=(), event=None):
+        with postgresql.PostgreSQL() as pgsql:
+            for i in pgsql.fetch_query_results(query, params=params, event=event):
+                yield i
 
-    def __sql_read(self, query, params=()):
-        for i in self.pgsql.fetch_query_results(query, params=params):
-            yield i
+    def __sql_stream(self, query, params=(), chunk_size=2000, event=None):
+        with postgresql.PostgreSQL() as pgsql:
+            for i in pgsql.stream_query_results(query, params=params, chunk_size=chunk_size, event=event):
+                yield i
+
+    def __sql_scalar(self, query, params=()):
+        with postgresql.PostgreSQL() as pgsql:
+            pgsql.query(query, params=params)
+            result = pgsql.fetchone()
+        return result[0] if result else None
 
     def __sql_delete(self, query, params=()):
-        self.pgsql.query(query, params=params)
-        self.pgsql.commit()
+        with postgresql.PostgreSQL() as pgsql:
+            pgsql.query(query, params=params)
+            pgsql.commit()
+
+    def __sql_update(self, query, params=()):
+        with postgresql.PostgreSQL() as pgsql:
+            pgsql.query(query, params=params)
+            rowcount = pgsql.cursor.rowcount
+            pgsql.commit()
+        return rowcount
 
     def __update_query_inputs(self, data):
         if data:
             for k, v in data.items():
                 self.__filter_exclude_inputs[k].update(v)
 
-    def __create_query(self):
+    def __column_restrictions(self):
+        restrictions = {}
+        for fields, only in ((self.__only_fields, True), (self.__deferred_fields, False)):
+            for path in fields:
+                fk_fields = path.split(sql.LOGICAL_SEPARATOR)
+                column = fk_fields.pop()
+                table_class = self.__table_class
+                for fk in fk_fields:
+                    if fk not in table_class._meta.foreign_keys:
+                        raise QueryException("Foreign key not found: {}".format(fk))
+                    table_class = table_class._meta.foreign_keys[fk].table_name
+                meta = table_class._meta
+                if column == "pk":
+                    column = meta.pk_name
+                if column not in meta.column_set:
+                    raise QueryException("Column not found: {}".format(path))
+                prefix = sql.LOGICAL_SEPARATOR.join(fk_fields)
+                if only:
+                    restrictions.setdefault(prefix, {meta.pk_name}).add(column)
+                elif column != meta.pk_name:
+                    restrictions.setdefault(prefix, set(meta.column_names)).discard(column)
+        columns = {}
+        for prefix, names in restrictions.items():
+            table_class = self.__table_class
+            for fk in prefix.split(sql.LOGICAL_SEPARATOR) if prefix else ():
+                table_class = table_class._meta.foreign_keys[fk].table_name
+            columns[prefix] = tuple(i for i in table_class._meta.column_names if i in names)
+        return columns.pop("", self.__table_columns), columns
+
+    @staticmethod
+    def _flush_session():
+        session = get_session()
+        if session is not None:
+            # Queries and direct writes inside a session see its pending writes.
+            session.flush()
+
+    def _create_query(self, count=False, exists=False, update=None, aggregate=None, delete=False):
+        self._flush_session()
+        query = self._compile_query(count=count, exists=exists, update=update, aggregate=aggregate, delete=delete)
+        plans.check_query(query["query"], query["params"])
+        return query
+
+    def _compile_query(self, count=False, exists=False, update=None, aggregate=None, delete=False):
+        table_columns, related_columns = self.__column_restrictions()
         query = sql.Query(
             schema=self.__table_class.get_schema(),
             table_class=self.__table_class,
-            table_columns=self.__table_columns,
-            pk=self.__table_class.get_pk_name(),
+            table_columns=table_columns,
+            pk=self.__table_class._meta.pk_name,
             order_dict=self.__filter_exclude_inputs["order_by"],
             filter_dict=self.__filter_exclude_inputs["filter"],
             or_filter_dict=self.__filter_exclude_inputs["or_filter"],
@@ -80,60 +335,30 @@ class RowSet:
             select_related=self.__select_related,
             limit=self.__limit,
             offset=self.__offset,
-            delete=self.__delete
+            delete=delete,
+            count=count,
+            exists=exists,
+            update=update,
+            values=self.__values_fields,
+            related_columns=related_columns,
+            annotations=aggregate if aggregate else self.__annotations,
+            aggregate=bool(aggregate),
+            after=self.__after
         )
-        sql_query, params, column_query, self.__table_details, self.__base_table_proxy = query.query()
-        self.__columns_order = [i.strip().strip('"') for i in column_query.split(",")]
-        return {"query": sql_query, "params": params}
-
-    def __set_attributes(self, column_values):
-        data_map = {}
-        used_proxies = []
-        for i in range(len(column_values)):
-            p, c = self.__columns_order[i].split(".")
-            if p not in data_map:
-                data_map[p] = {}
-            data_map[p][c] = column_values[i]
-        data_map = OrderedDict(sorted([(k, v) for k, v in data_map.items()], key=lambda x:x[0]))
-
-        def get_table_proxy(tbl_class, base_tbl_class, f_key):
-            for proxy_k, proxy_v in self.__table_details.items():
-                conditions = (
-                    proxy_v["details"]["fk_table_class"] == tbl_class and
-                    proxy_v["details"]["base_table_class"] == base_tbl_class and
-                    proxy_v["details"]["key"] == f_key
+        compiled, params = query.compile()
+        self.__table_details = compiled.table_details
+        if not (count or exists or update or aggregate or delete or self.__values_mode):
+            self.__base_table_proxy = compiled.base_table_proxy
+            if compiled.row_decoder is None:
+                compiled.row_decoder = RowDecoder(
+                    table_class=self.__table_class,
+                    base_table_proxy=compiled.base_table_proxy,
+                    table_details=compiled.table_details,
+                    columns_order=[i.strip().strip('"') for i in compiled.column_query.split(",")],
+                    annotations=tuple(self.__annotations)
                 )
-                if conditions and proxy_k not in used_proxies:
-                    used_proxies.append(proxy_k)
-                    return proxy_k
-            return
-
-        def fill_table_attributes(proxy_name):
-            if proxy_name == self.__base_table_proxy:
-                table_class = self.__table_class
-            else:
-                table_class = self.__table_details[proxy_name]["details"]["fk_table_class"]
-            obj = table_class()
-            for column in table_class.get_column_names():
-                if isinstance(table_class.__dict__[column], datatypes.ForeignKeyField):
-                    obj_fk_table_class = getattr(table_class.__dict__[column], "table_name")
-                    fk_proxy = get_table_proxy(
-                        tbl_class=obj_fk_table_class,
-                        base_tbl_class=table_class,
-                        f_key=column
-                    )
-                    if fk_proxy:
-                        setattr(obj, column, fill_table_attributes(fk_proxy))
-                    else:
-                        obj_f_key = deepcopy(table_class.__dict__[column])
-                        obj_f_key.set_value(data_map[proxy_name][column])
-                        setattr(obj, column, obj_f_key)
-                else:
-                    setattr(obj, column, data_map[proxy_name][column])
-            return obj
-
-        main_obj = fill_table_attributes(proxy_name=self.__base_table_proxy)
-        return main_obj
+            self.__row_decoder = compiled.row_decoder
+        return {"query": compiled.sql, "params": params}
 
     def __getitem__(self, index):
         if isinstance(index, slice):
@@ -149,23 +374,86 @@ class RowSet:
                 if stop < start:
                     raise ValueError("Stop index cannot be negative and less than Start index.")
                 self.__limit = stop - start
-            return self.__iter__()
+            return self
         if isinstance(index, int):
             if index < 0:
                 raise ValueError("Index cannot be negative.")
             self.__limit = 1
             self.__offset = index
-            return [i for i in self.__iter__()][0]
+            objects_found = [i for i in self.__iter__()]
+            if not objects_found:
+                raise IndexError("Index out of range.")
+            return objects_found[0]
         raise ValueError("Invalid index.")
 
-    def __iter__(self):
-        if self.__value is None:
-            for i in self.__sql_read(**self.__create_query()):
-                obj = self.__set_attributes(i)
+    def __decode_values(self, rows):
+        if self.__values_mode == "tuple":
+            return rows
+        if self.__values_mode == "flat":
+            return (i[0] for i in rows)
+        names = self.__values_fields + list(self.__annotations)
+        return (dict(zip(names, i)) for i in rows)
+
+    def _decode_rows(self, rows, batch_size=PREFETCH_BATCH_SIZE):
+        if self.__values_mode:
+            for i in self.__decode_values(rows):
+                yield i
+            return
+        decode = self.__row_decoder.decode
+        if not (self.__prefetch_related or self.__row_decoder.has_deferred):
+            for i in rows:
+                yield decode(i)
+            return
+        for batch in batched(rows, batch_size):
+            loaders = {}
+            obj_list = [decode(i, loaders) for i in batch]
+            if self.__prefetch_related:
+                prefetch_related_objects(obj_list, *self.__prefetch_related)
+            for obj in obj_list:
                 yield obj
+
+    def __cached_rows(self, query, fetch):
+        # Reads inside a transaction may see uncommitted rows, they neither use nor fill the cache.
+        if self.__cache_ttl is None or postgresql.get_transaction() is not None:
+            return fetch()
+        backend = cache.get_backend()
+        key = cache.make_key(query["query"], query["params"])
+        rows = backend.get(key)
+        if rows is None:
+            tables = {i["details"]["fk_table_name"] for i in self.__table_details.values()}
+            tables.add(self.__table_class.get_full_table_name())
+            tables = sorted(tables)
+            generations = backend.generations(tables)
+            rows = [i for i in fetch()]
+            backend.set(key, rows, self.__cache_ttl, tables, generations)
+        return rows
+
+    def __read_objects(self, read, batch_size=PREFETCH_BATCH_SIZE, cached=False, **kwargs):
+        event = instrumentation.start()
+        if event is None:
+            query = self._create_query()
+            rows = self.__cached_rows(query, lambda: read(**query, **kwargs)) if cached else read(**query, **kwargs)
+            return self._decode_rows(rows, batch_size=batch_size)
+        start = time.perf_counter()
+        query = self._create_query()
+        event.compile_time = time.perf_counter() - start
+        event.sql = query["query"]
+        event.params_count = len(query["params"])
+        if cached:
+            rows = self.__cached_rows(query, lambda: read(event=event, **query, **kwargs))
         else:
-            for i in self.__value:
-                yield i
+            rows = read(event=event, **query, **kwargs)
+        return instrumentation.instrument_rows(event, self._decode_rows(rows, batch_size=batch_size))
+
+    def __iter__(self):
+        for obj in self.__read_objects(self.__sql_read, cached=True):
+            yield obj
+
+    def iterator(self, chunk_size=2000):
+        if chunk_size < 1:
+            raise ValueError("chunk_size should be a positive integer.")
+        for obj in self.__read_objects(self.__sql_stream, batch_size=chunk_size, chunk_size=chunk_size):
+            yield obj
 
     def __next__(self):
         return next(self.__iter__())
@@ -181,16 +469,44 @@ class RowSet:
         obj.save(commit=True)
         return obj
 
-    def bulk_create(self, obj_list):
-        params = []
-        base_table = "{}.{}".format(self.__table_class.get_schema(), self.__table_class.get_table_name())
-        column_names = [i for i in self.__table_class.get_column_names() if i != "id"]
-        columns = ['"{}"'.format(i) for i in column_names if i != "id"]
-        query = 'INSERT INTO ' + base_table + ' (' + ", ".join(columns) + ') VALUES {};'
-        for obj in obj_list:
-            params.append(tuple([obj[k] for k in column_names]))
-        self.pgsql.insert_many(query, params=params)
-        self.pgsql.commit()
+    def _bulk_row(self, obj, column_names):
+        if isinstance(obj, dict):
+            values = [obj[k] for k in column_names]
+        else:
+            values = [getattr(obj, k) for k in column_names]
+        foreign_keys = self.__table_class._meta.foreign_keys
+        return tuple([
+            self.__table_class.get_value_or_object_pk(v) if k in foreign_keys else v
+            for k, v in zip(column_names, values)
+        ])
+
+    def bulk_create(self, obj_list, batch_size=1000, return_ids=False):
+        if batch_size < 1:
+            raise ValueError("batch_size should be a positive integer.")
+        self._flush_session()
+        meta = self.__table_class._meta
+        base_table = self.__table_class.get_full_table_name()
+        column_names = [i for i in meta.column_names if i != "id"]
+        columns = [meta.quoted_column_names[i] for i in column_names]
+        query = "INSERT INTO {} ({}) VALUES %s RETURNING id;".format(base_table, ", ".join(columns))
+        ids = []
+        with postgresql.PostgreSQL() as pgsql:
+            for batch in batched(obj_list, batch_size):
+                rows = [self._bulk_row(obj, column_names) for obj in batch]
+                if not return_ids:
+                    pgsql.copy_rows(base_table, columns, rows)
+                    continue
+                batch_ids = [i[0] for i in pgsql.insert_returning(query, rows)]
+                for obj, obj_id in zip(batch, batch_ids):
+                    if isinstance(obj, dict):
+                        obj["id"] = obj_id
+                    else:
+                        obj.__dict__["id"] = obj_id
+                ids.extend(batch_ids)
+            pgsql.commit()
+        cache.invalidate(self.__table_class)
+        if return_ids:
+            return ids
 
     def order_by(self, params):
         data = {}
@@ -199,7 +515,7 @@ class RowSet:
         for i in params:
             order = "DESC" if i[0] == "-" else "ASC"
             column_name = i[1:] if i[0] == "-" else i
-            if column_name not in self.__table_columns:
+            if column_name not in self.__table_columns and column_name not in self.__annotations:
                 raise QueryException("Column not found: {}".format(column_name))
             data[column_name] = order
         self.__update_query_inputs({"order_by": data})
@@ -225,11 +541,108 @@ class RowSet:
         if args:
             self.__select_related = [i for i in args]
         else:
-            self.__select_related = [k for k, v in self.__table_class.__dict__.items() if isinstance(v, datatypes.ForeignKeyField)]
+            self.__select_related = list(self.__table_class._meta.foreign_keys)
+        return self
+
+    def prefetch_related(self, *args):
+        for lookup in args:
+            table_class = self.__table_class
+            for fk in lookup.split(sql.LOGICAL_SEPARATOR):
+                if fk not in table_class._meta.foreign_keys:
+                    raise QueryException("Foreign key not found: {}".format(fk))
+                table_class = table_class._meta.foreign_keys[fk].table_name
+        self.__prefetch_related = [i for i in args]
+        return self
+
+    def only(self, *fields):
+        self.__only_fields = list(fields)
+        self.__column_restrictions()
+        return self
+
+    def defer(self, *fields):
+        self.__deferred_fields = list(fields)
+        self.__column_restrictions()
+        return self
+
+    def cache(self, ttl=60):
+        if ttl is not None and ttl <= 0:
+            raise ValueError("ttl should be a positive number of seconds.")
+        self.__cache_ttl = ttl
+        return self
+
+    def values(self, *fields):
+        self.__values_fields = list(fields) if fields else list(self.__table_class._meta.column_names)
+        self.__values_mode = "dict"
+        return self
+
+    def values_list(self, *fields, flat=False):
+        if flat and len(fields) != 1:
+            raise QueryException("flat=True is only valid with a single field.")
+        self.__values_fields = list(fields) if fields else list(self.__table_class._meta.column_names)
+        self.__values_mode = "flat" if flat else "tuple"
+        return self
+
+    def __validate_aggregates(self, kwargs):
+        for alias, aggregate in kwargs.items():
+            if not isinstance(aggregate, Aggregate):
+                raise QueryException("Not an aggregate: {}".format(alias))
+            if alias in self.__table_class._meta.column_set:
+                raise QueryException("The annotation {} conflicts with a column.".format(alias))
+
+    def annotate(self, **kwargs):
+        self.__validate_aggregates(kwargs)
+        self.__annotations.update(kwargs)
         return self
 
+    def _aggregate_query(self, kwargs):
+        if self.__limit is not None or self.__offset:
+            raise QueryException("Cannot aggregate a sliced query.")
+        if not kwargs:
+            return None
+        self.__validate_aggregates(kwargs)
+        return self._create_query(aggregate=kwargs)
+
+    def aggregate(self, **kwargs):
+        query = self._aggregate_query(kwargs)
+        if query is None:
+            return {}
+        rows = self.__cached_rows(query, lambda: [i for i in self.__sql_read(**query)])
+        return dict(zip(kwargs, rows[0]))
+
+    def paginate_by_key(self, order_by, after=None, page_size=100):
+        if page_size < 1:
+            raise ValueError("page_size should be a positive integer.")
+        if self.__values_mode or self.__annotations:
+            raise QueryException("Keyset pagination is only supported for model rows.")
+        self.__filter_exclude_inputs["order_by"] = {}
+        self.order_by(order_by)
+        order = self.__filter_exclude_inputs["order_by"]
+        if len(set(order.values())) != 1:
+            raise QueryException("Keyset pagination needs the same direction for every ordering column.")
+        meta = self.__table_class._meta
+        for column in order:
+            # A row comparison with a NULL is never true, those rows would silently drop out of every page.
+            if meta.fields[column].null:
+                raise QueryException("Keyset pagination columns cannot be nullable: {}".format(column))
+        order.setdefault(meta.pk_name, next(iter(order.values())))
+        if after is not None:
+            after = decode_page_token(after)
+            if len(after) != len(order):
+                raise QueryException("Invalid pagination token.")
+        self.__after = after
+        self.__limit = page_size + 1
+        self.__offset = None
+        objects = [i for i in self.__iter__()]
+        if len(objects) <= page_size:
+            return objects, None
+        objects = objects[:page_size]
+        last = objects[-1]
+        values = [self.__table_class.get_value_or_object_pk(getattr(last, i)) for i in order]
+        return objects, encode_page_token(values)
+
     def get(self, **kwargs):
         self.__filter_exclude_inputs["filter"] = kwargs
+        self.__limit = 2
         objects_found = [i for i in self.__iter__()]
         if not objects_found:
             raise ObjectDoesNotExist("Object does not exist.")
@@ -237,17 +650,193 @@ class RowSet:
             raise MultipleObjectsFound("Multiple objects found.")
         return objects_found[0]
 
-    def get_or_create(self, **kwargs):
+    def first(self):
+        self.__limit = 1
+        objects_found = [i for i in self.__iter__()]
+        return objects_found[0] if objects_found else None
+
+    def _reverse_ordering(self):
+        order = self.__filter_exclude_inputs["order_by"]
+        if order:
+            for k, v in order.items():
+                order[k] = "ASC" if v == "DESC" else "DESC"
+        else:
+            order[self.__table_class._meta.pk_name] = "DESC"
+
+    def last(self):
+        self._reverse_ordering()
+        return self.first()
+
+    def __unique_together(self):
+        meta_field = self.__table_class._get_meta_field()
+        if not meta_field:
+            return []
+        return [tuple(i) for i in meta_field.__dict__.get("unique_together", ())]
+
+    def _conflict_fields(self, kwargs):
+        for fields in self.__unique_together():
+            if set(fields) == set(kwargs):
+                return list(fields)
+        return None
+
+    def __row_params(self, values, column_names):
+        foreign_keys = self.__table_class._meta.foreign_keys
+        return [
+            self.__table_class.get_value_or_object_pk(values[i]) if i in foreign_keys else values[i]
+            for i in column_names
+        ]
+
+    def __hydrate_row(self, row):
+        meta = self.__table_class._meta
+        decoder = RowDecoder(
+            table_class=self.__table_class,
+            base_table_proxy="table_0",
+            table_details={},
+            columns_order=["table_0.{}".format(i) for i in meta.column_names]
+        )
+        return decoder.decode(row)
+
+    def _upsert_query(self, kwargs, defaults, conflict_fields, update):
+        meta = self.__table_class._meta
+        values = dict(kwargs)
+        values.update(defaults)
+        for column in values:
+            if column not in meta.column_set or column == meta.pk_name:
+                raise QueryException("Column cannot be inserted: {}".format(column))
+        column_names = [i for i in meta.column_names if i in values]
+        returning = ", ".join([meta.quoted_column_names[i] for i in meta.column_names])
+        formats = {
+            "schema": self.__table_class.get_schema(),
+            "table_name": meta.table_name,
+            "column_names": ", ".join([meta.quoted_column_names[i] for i in column_names]),
+            "column_values": ", ".join(["%s"] * len(column_names)),
+            "conflict_columns": ", ".join([meta.quoted_column_names[i] for i in conflict_fields])
+        }
+        params = self.__row_params(values, column_names)
+        if update:
+            update_fields = [i for i in column_names if i in defaults] or conflict_fields
+            query = sql.upsert_rows().format(
+                action="DO UPDATE SET {}".format(", ".join(
+                    ["{0}=EXCLUDED.{0}".format(meta.quoted_column_names[i]) for i in update_fields])),
+                returning=returning + ", (xmax = 0)",
+                **dict(formats, column_values="({})".format(formats["column_values"]))
+            )
+        else:
+            query = sql.get_or_create_row().format(
+                returning=returning,
+                condition=" AND ".join(["{}=%s".format(meta.quoted_column_names[i]) for i in conflict_fields]),
+                **formats
+            )
+            params += self.__row_params(kwargs, conflict_fields)
+        return {"query": query, "params": params}
+
+    def _upserted_object(self, row):
+        if row is None:
+            raise ObjectDoesNotExist("Object does not exist.")
+        return self.__hydrate_row(row[:-1]), row[-1]
+
+    def __insert_on_conflict(self, kwargs, defaults, conflict_fields, update):
+        self._flush_session()
+        query = self._upsert_query(kwargs, defaults, conflict_fields, update)
+        row = None
+        with postgresql.PostgreSQL() as pgsql:
+            # A row inserted concurrently after the statement's snapshot is neither inserted nor visible, run it again.
+            for _ in range(UPSERT_ATTEMPTS):
+                pgsql.query(query["query"], params=query["params"])
+                row = pgsql.fetchone()
+                if row is not None:
+                    break
+            pgsql.commit()
+        cache.invalidate(self.__table_class)
+        return self._upserted_object(row)
+
+    def get_or_create(self, defaults=None, **kwargs):
+        defaults = defaults if defaults else {}
+        conflict_fields = self._conflict_fields(kwargs)
+        if conflict_fields:
+            return self.__insert_on_conflict(kwargs, defaults, conflict_fields, update=False)
         created = False
         try:
             obj = self.get(**kwargs)
         except ObjectDoesNotExist:
-            obj = self.create(**kwargs)
+            obj = self.create(**dict(kwargs, **defaults))
             created = True
         except MultipleObjectsFound as e:
             raise e
         return obj, created
 
+    def update_or_create(self, defaults=None, **kwargs):
+        defaults = defaults if defaults else {}
+        conflict_fields = self._conflict_fields(kwargs)
+        if conflict_fields:
+            return self.__insert_on_conflict(kwargs, defaults, conflict_fields, update=True)
+        try:
+            obj = self.get(**kwargs)
+        except ObjectDoesNotExist:
+            return self.create(**dict(kwargs, **defaults)), True
+        for k, v in defaults.items():
+            setattr(obj, k, v)
+        obj.save()
+        return obj, False
+
+    def bulk_upsert(self, obj_list, conflict_fields=None, update_fields=None, batch_size=1000):
+        if batch_size < 1:
+            raise ValueError("batch_size should be a positive integer.")
+        self._flush_session()
+        meta = self.__table_class._meta
+        if conflict_fields is None:
+            unique_together = self.__unique_together()
+            if not unique_together:
+                raise QueryException("No conflict_fields given and the model has no unique_together.")
+            conflict_fields = unique_together[0]
+        conflict_fields = list(conflict_fields)
+        column_names = [i for i in meta.column_names if i != "id"]
+        if update_fields is None:
+            update_fields = [i for i in column_names if i not in conflict_fields]
+        for field in itertools.chain(conflict_fields, update_fields):
+            if field not in meta.column_set or field == meta.pk_name:
+                raise QueryException("Column cannot be upserted: {}".format(field))
+        if update_fields:
+            action = "DO UPDATE SET {}".format(", ".join(
+                ["{0}=EXCLUDED.{0}".format(meta.quoted_column_names[i]) for i in update_fields]))
+        else:
+            action = "DO NOTHING"
+        query = sql.upsert_rows().format(
+            schema=self.__table_class.get_schema(),
+            table_name=meta.table_name,
+            column_names=", ".join([meta.quoted_column_names[i] for i in column_names]),
+            column_values="%s",
+            conflict_columns=", ".join([meta.quoted_column_names[i] for i in conflict_fields]),
+            action=action,
+            returning=", ".join([meta.quoted_column_names[i] for i in [meta.pk_name] + conflict_fields])
+        )
+        positions = [column_names.index(i) for i in conflict_fields]
+        upserted = 0
+        with postgresql.PostgreSQL() as pgsql:
+            for batch in batched(obj_list, batch_size):
+                # ON CONFLICT cannot touch the same row twice in one statement, the last duplicate wins.
+                rows = {}
+                owners = {}
+                for obj in batch:
+                    row = self._bulk_row(obj, column_names)
+                    key = tuple(row[i] for i in positions)
+                    if None in key:
+                        key = (id(obj), )
+                    rows[key] = row
+                    owners.setdefault(key, []).append(obj)
+                results = pgsql.insert_returning(query, list(rows.values()))
+                for result in results:
+                    for obj in owners.get(tuple(result[1:]), ()):
+                        if isinstance(obj, dict):
+                            obj[meta.pk_name] = result[0]
+                        else:
+                            obj.__dict__[meta.pk_name] = result[0]
+                            obj._clear_dirty_fields()
+                upserted += len(results)
+            pgsql.commit()
+        cache.invalidate(self.__table_class)
+        return upserted
+
     def get_or_none(self, **kwargs):
         try:
             obj = self.get(**kwargs)
@@ -257,12 +846,76 @@ class RowSet:
         return None
 
     def delete(self):
-        self.__delete = True
-        self.__sql_delete(**self.__create_query())
+        self.__sql_delete(**self._create_query(delete=True))
+        cache.invalidate(self.__table_class)
+
+    def _update_query(self, kwargs):
+        if self.__limit is not None or self.__offset:
+            raise QueryException("Cannot update a sliced query.")
+        if not kwargs:
+            return None
+        meta = self.__table_class._meta
+        values = {}
+        for column, value in kwargs.items():
+            if column not in meta.column_set:
+                raise QueryException("Column not found: {}".format(column))
+            if column in meta.foreign_keys:
+                value = self.__table_class.get_value_or_object_pk(value)
+            values[column] = value
+        return self._create_query(update=values)
+
+    def update(self, **kwargs):
+        query = self._update_query(kwargs)
+        if query is None:
+            return 0
+        rowcount = self.__sql_update(**query)
+        cache.invalidate(self.__table_class)
+        return rowcount
+
+    def bulk_update(self, obj_list, fields, batch_size=1000):
+        if batch_size < 1:
+            raise ValueError("batch_size should be a positive integer.")
+        self._flush_session()
+        meta = self.__table_class._meta
+        fields = list(fields)
+        if not fields:
+            raise QueryException("No fields given to update.")
+        for field in fields:
+            if field not in meta.column_set or field == meta.pk_name:
+                raise QueryException("Column cannot be updated: {}".format(field))
+        column_names = [meta.pk_name] + fields
+        query = sql.update_from_values().format(
+            schema=self.__table_class.get_schema(),
+            table_name=meta.table_name,
+            alias="table_0",
+            set_key_value=", ".join(["{0}=data.{0}".format(meta.quoted_column_names[i]) for i in fields]),
+            values_alias="data",
+            columns=", ".join([meta.quoted_column_names[i] for i in column_names]),
+            condition="table_0.{0}=data.{0}".format(meta.quoted_column_names[meta.pk_name])
+        )
+        template = "({})".format(", ".join(["%s::{}".format(meta.fields[i].cast_type) for i in column_names]))
+        updated = 0
+        with postgresql.PostgreSQL() as pgsql:
+            for batch in batched(obj_list, batch_size):
+                rows = [self._bulk_row(obj, column_names) for obj in batch]
+                if any(row[0] is None for row in rows):
+                    raise QueryException("Missing primary key for an object in bulk_update.")
+                updated += pgsql.execute_values(query, rows, template=template)
+            pgsql.commit()
+        cache.invalidate(self.__table_class)
+        return updated
+
+    def explain(self, analyze=False, buffers=False, format="json"):
+        query = self._create_query()
+        return plans.explain(query["query"], params=query["params"], analyze=analyze, buffers=buffers, format=format)
 
     def count(self):
-        self.__value = [i for i in self]
-        return len(self.__value) if self.__value else 0
+        query = self._create_query(count=True)
+        return self.__cached_rows(query, lambda: [(self.__sql_scalar(**query), )])[0][0]
+
+    def exists(self):
+        query = self._create_query(exists=True)
+        return self.__cached_rows(query, lambda: [(self.__sql_scalar(**query), )])[0][0] is not None
 
 
 class Objects:
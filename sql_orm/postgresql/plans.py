@@ -0,0 +1,103 @@
+import logging
+import threading
+
+from sql_orm import postgresql
+
+
+PLAN_LOGGER = logging.getLogger("sql_orm.plans")
+FORMATS = ("json", "text", "xml", "yaml")
+
+_SEQ_SCAN_THRESHOLD = postgresql.CONFIG.get("POSTGRESQL", "SEQ_SCAN_WARNING_ROWS", fallback=None)
+_SETTINGS = {"seq_scan_threshold": int(_SEQ_SCAN_THRESHOLD) if _SEQ_SCAN_THRESHOLD else None}
+_CHECKED_SHAPES = set()
+_LOCK = threading.Lock()
+
+
+class QueryPlan:
+
+    def __init__(self, result):
+        self.raw = result
+        self.root = result["Plan"]
+        self.planning_time = result.get("Planning Time")
+        self.execution_time = result.get("Execution Time")
+
+    def __repr__(self):
+        return "<QueryPlan {} cost={} rows={}>".format(self.root["Node Type"], self.total_cost, self.plan_rows)
+
+    @property
+    def total_cost(self):
+        return self.root["Total Cost"]
+
+    @property
+    def plan_rows(self):
+        return self.root["Plan Rows"]
+
+    def nodes(self):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.get("Plans", ())))
+
+    def seq_scans(self):
+        return [i for i in self.nodes() if i["Node Type"] == "Seq Scan"]
+
+
+def explain(sql, params=None, analyze=False, buffers=False, format="json", verbose=False):
+    if format not in FORMATS:
+        raise ValueError("Invalid EXPLAIN format: {}. Expected one of {}.".format(format, ", ".join(FORMATS)))
+    options = ["FORMAT {}".format(format.upper())]
+    if analyze:
+        options.append("ANALYZE")
+    if buffers:
+        options.append("BUFFERS")
+    if verbose:
+        options.append("VERBOSE")
+    with postgresql.PostgreSQL() as pgsql:
+        pgsql.query("EXPLAIN ({}) {}".format(", ".join(options), sql), params=params)
+        rows = pgsql.fetchall()
+        pgsql.commit()
+    if format == "text":
+        return "\n".join([i[0] for i in rows])
+    if format == "json":
+        return QueryPlan(rows[0][0][0])
+    return rows[0][0]
+
+
+def set_seq_scan_threshold(rows):
+    _SETTINGS["seq_scan_threshold"] = int(rows) if rows is not None else None
+    with _LOCK:
+        _CHECKED_SHAPES.clear()
+
+
+def _table_rows(pgsql, node):
+    pgsql.query(
+        "SELECT reltuples FROM pg_class WHERE oid = %s::regclass;",
+        params=('"{}"."{}"'.format(node["Schema"], node["Relation Name"]), )
+    )
+    row = pgsql.fetchone()
+    # Tables never analyzed or vacuumed report -1, fall back to the planner's row estimate.
+    return row[0] if row and row[0] >= 0 else node["Plan Rows"]
+
+
+def check_query(sql, params=None):
+    # Development aid: every query shape is explained once, Seq Scans over large tables are logged.
+    threshold = _SETTINGS["seq_scan_threshold"]
+    if threshold is None:
+        return
+    with _LOCK:
+        if sql in _CHECKED_SHAPES:
+            return
+        _CHECKED_SHAPES.add(sql)
+    seq_scans = explain(sql, params=params, verbose=True).seq_scans()
+    if not seq_scans:
+        return
+    with postgresql.PostgreSQL() as pgsql:
+        for node in seq_scans:
+            rows = _table_rows(pgsql, node)
+            if rows > threshold:
+                PLAN_LOGGER.warning(
+                    "Seq Scan on %s.%s (about %d rows, threshold %d), an index may be missing: %s",
+                    node["Schema"], node["Relation Name"], rows, threshold, sql
+                )
+        pgsql.commit()
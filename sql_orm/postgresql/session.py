@@ -0,0 +1,148 @@
+from collections import OrderedDict
+from contextvars import ContextVar
+
+from sql_orm import SQLException, Table
+from sql_orm.postgresql import Atomic
+
+
+_SESSION = ContextVar("sql_orm_session", default=None)
+
+
+class Session:
+
+    def __init__(self, pool=None, batch_size=1000):
+        self.batch_size = batch_size
+        self.__atomic = Atomic(pool=pool)
+        self.__tokens = []
+        self.__inserts = OrderedDict()
+        self.__updates = OrderedDict()
+        self.__deletes = OrderedDict()
+        self.__flushing = False
+
+    def __enter__(self):
+        self.__atomic.__enter__()
+        self.__tokens.append(_SESSION.set(self))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _SESSION.reset(self.__tokens.pop())
+        if exc_type is None:
+            try:
+                self.flush()
+            except BaseException as error:
+                self.__atomic.__exit__(type(error), error, error.__traceback__)
+                raise
+        else:
+            self.clear()
+        return self.__atomic.__exit__(exc_type, exc_value, traceback)
+
+    def __len__(self):
+        return (
+            sum(len(i) for i in self.__inserts.values()) +
+            len(self.__updates) +
+            sum(len(i) for i in self.__deletes.values())
+        )
+
+    @property
+    def pending(self):
+        return bool(self.__inserts or self.__updates or self.__deletes)
+
+    def add(self, obj, update_fields=None):
+        table_class = obj.__class__
+        meta = table_class._meta
+        if not obj.pk:
+            self.__inserts.setdefault(table_class, OrderedDict())[id(obj)] = obj
+            return
+        if update_fields is None:
+            dirty_fields = obj.get_dirty_fields()
+            column_names = {i for i in meta.non_pk_column_names if i in dirty_fields}
+        else:
+            column_names = set(update_fields)
+            for i in column_names:
+                if i not in meta.column_set or i == meta.pk_name:
+                    raise SQLException("Column cannot be updated: {}".format(i))
+        if not column_names:
+            return
+        _, pending_fields = self.__updates.setdefault(id(obj), (obj, set()))
+        pending_fields.update(column_names)
+
+    def delete(self, obj):
+        table_class = obj.__class__
+        if not obj.pk:
+            if self.__inserts.get(table_class, {}).pop(id(obj), None) is None:
+                raise SQLException("Missing primary key for the given object.")
+            return
+        self.__updates.pop(id(obj), None)
+        self.__deletes.setdefault(table_class, OrderedDict())[obj.pk] = obj
+
+    def clear(self):
+        self.__inserts.clear()
+        self.__updates.clear()
+        self.__deletes.clear()
+
+    @staticmethod
+    def __insert_order(inserts):
+        # Parents first, so foreign keys to objects inserted in the same flush get their ids.
+        ordered = []
+        visiting = set()
+
+        def visit(table_class):
+            if table_class in ordered or table_class in visiting:
+                return
+            visiting.add(table_class)
+            for field in table_class._meta.foreign_keys.values():
+                if field.table_name in inserts:
+                    visit(field.table_name)
+            visiting.discard(table_class)
+            ordered.append(table_class)
+
+        for table_class in inserts:
+            visit(table_class)
+        return ordered
+
+    @staticmethod
+    def __check_foreign_keys(table_class, obj_list):
+        for obj in obj_list:
+            for name in table_class._meta.foreign_keys:
+                value = obj.__dict__.get(name)
+                if isinstance(value, Table) and not value.pk:
+                    raise SQLException(
+                        "{}.{} refers to an object without a primary key.".format(table_class.__name__, name))
+
+    def flush(self):
+        if self.__flushing or not self.pending:
+            return
+        inserts, updates, deletes = self.__inserts, self.__updates, self.__deletes
+        self.__inserts, self.__updates, self.__deletes = OrderedDict(), OrderedDict(), OrderedDict()
+        self.__flushing = True
+        try:
+            # Row values are read at flush time so foreign keys to objects inserted earlier in the flush get their ids.
+            for table_class in self.__insert_order(inserts):
+                obj_list = list(inserts[table_class].values())
+                self.__check_foreign_keys(table_class, obj_list)
+                table_class.objects.bulk_create(obj_list, batch_size=self.batch_size, return_ids=True)
+                for obj in obj_list:
+                    obj._clear_dirty_fields()
+            shapes = OrderedDict()
+            for obj, column_names in updates.values():
+                key = (obj.__class__, tuple(sorted(column_names)))
+                shapes.setdefault(key, []).append(obj)
+            for (table_class, column_names), obj_list in shapes.items():
+                table_class.objects.bulk_update(obj_list, column_names, batch_size=self.batch_size)
+                for obj in obj_list:
+                    obj._clear_dirty_fields(column_names)
+            for table_class, objects in deletes.items():
+                lookup_key = "{}__in".format(table_class._meta.pk_name)
+                pks = list(objects)
+                for i in range(0, len(pks), self.batch_size):
+                    table_class.objects.filter(**{lookup_key: pks[i:i + self.batch_size]}).delete()
+        finally:
+            self.__flushing = False
+
+
+def session(pool=None, batch_size=1000):
+    return Session(pool=pool, batch_size=batch_size)
+
+
+def get_session():
+    return _SESSION.get()
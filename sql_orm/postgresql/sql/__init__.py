@@ -1,5 +1,6 @@
 from sql_orm import FKFieldTree
 from collections import OrderedDict
+import threading
 
 
 class InvalidQueryException(Exception):
@@ -26,12 +27,151 @@ def update_table_row():
     return "UPDATE {schema}.{table_name} SET {set_key_value} WHERE {condition};"
 
 
+def update_from_values():
+    return (
+        "UPDATE {schema}.{table_name} AS {alias} SET {set_key_value} "
+        "FROM (VALUES %s) AS {values_alias} ({columns}) WHERE {condition};"
+    )
+
+
+def upsert_rows():
+    return (
+        "INSERT INTO {schema}.{table_name} ({column_names}) VALUES {column_values} "
+        "ON CONFLICT ({conflict_columns}) {action} RETURNING {returning};"
+    )
+
+
+def get_or_create_row():
+    return (
+        "WITH inserted AS (INSERT INTO {schema}.{table_name} ({column_names}) VALUES ({column_values}) "
+        "ON CONFLICT ({conflict_columns}) DO NOTHING RETURNING {returning}) "
+        "SELECT {returning}, TRUE FROM inserted UNION ALL "
+        "SELECT {returning}, FALSE FROM {schema}.{table_name} WHERE {condition} LIMIT 1;"
+    )
+
+
 def add_unique_together():
-    return "ALTER TABLE {schema}.{table_name} ADD CONSTRAINT {constraint_name} UNIQUE ({columns});"
+    # Constraints created before the table name was part of the constraint name are renamed (or dropped
+    # when the new one already exists) instead of being duplicated.
+    return (
+        "DO $$ BEGIN "
+        "IF EXISTS (SELECT 1 FROM pg_constraint WHERE conname = '{old_constraint_name}' "
+        "AND conrelid = '{schema}.{table_name}'::regclass) THEN "
+        "IF EXISTS (SELECT 1 FROM pg_constraint WHERE conname = '{constraint_name}' "
+        "AND conrelid = '{schema}.{table_name}'::regclass) THEN "
+        "ALTER TABLE {schema}.{table_name} DROP CONSTRAINT {old_constraint_name}; "
+        "ELSE ALTER TABLE {schema}.{table_name} RENAME CONSTRAINT {old_constraint_name} TO {constraint_name}; "
+        "END IF; "
+        "END IF; "
+        "BEGIN "
+        "ALTER TABLE {schema}.{table_name} ADD CONSTRAINT {constraint_name} UNIQUE ({columns}); "
+        "EXCEPTION WHEN duplicate_table OR duplicate_object THEN NULL; "
+        "END; "
+        "END $$;"
+    )
 
 
 LOGICAL_SEPARATOR = "__"
 
+OPERATORS = {
+    "gt": ">",
+    "gte": ">=",
+    "lt": "<",
+    "lte": "<=",
+    "exact": "=",
+    "iexact": "=",
+    "contains": "LIKE",
+    "icontains": "ILIKE",
+    "startswith": "LIKE",
+    "istartswith": "ILIKE",
+    "endswith": "LIKE",
+    "iendswith": "ILIKE",
+    "isnull": "IS",
+    "in": "=",
+}
+
+
+def split_lookup(key):
+    key_splits = key.split(LOGICAL_SEPARATOR)
+    if len(key_splits) > 1 and key_splits[-1] in OPERATORS:
+        return key_splits[:-2], key_splits[-2], key_splits[-1]
+    return key_splits[:-1], key_splits[-1], "="
+
+
+def condition_params(condition, value):
+    if condition == "isnull":
+        return []
+    if condition == "in":
+        if not isinstance(value, list):
+            raise InvalidQueryException("Value should be a list.")
+        return [value]
+    if condition == "contains" or condition == "icontains":
+        return ["%{}%".format(value)]
+    if condition == "startswith" or condition == "istartswith":
+        return ["{}%".format(value)]
+    if condition == "endswith" or condition == "iendswith":
+        return ["%{}".format(value)]
+    return [value]
+
+
+class CompiledQuery:
+
+    def __init__(self, sql, column_query, table_details, base_table_proxy, param_plan):
+        self.sql = sql
+        self.column_query = column_query
+        self.table_details = table_details
+        self.base_table_proxy = base_table_proxy
+        self.param_plan = param_plan
+        self.row_decoder = None
+
+
+class QueryCache:
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key):
+        with self.__lock:
+            compiled = self.__entries.get(key)
+            if compiled is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.__entries.move_to_end(key)
+            return compiled
+
+    def set(self, key, compiled):
+        with self.__lock:
+            self.__entries[key] = compiled
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.__entries),
+                "maxsize": self.maxsize
+            }
+
+
+QUERY_CACHE = QueryCache()
+
 
 class Query:
 
@@ -48,7 +188,15 @@ class Query:
             select_related=None,
             limit=None,
             offset=None,
-            delete=False
+            delete=False,
+            count=False,
+            exists=False,
+            update=None,
+            values=None,
+            related_columns=None,
+            annotations=None,
+            aggregate=False,
+            after=None
     ):
         self.__schema = schema
         self.__table_class = table_class
@@ -57,6 +205,7 @@ class Query:
         self.__table_columns = table_columns
         self.__pk = pk
 
+        self.__ordered = bool(order_dict)
         self.__order_dict = order_dict if order_dict else {"id": "ASC"}
         self.__filter_dict = filter_dict if filter_dict else {}
         self.__or_filter_dict = or_filter_dict if or_filter_dict else {}
@@ -66,28 +215,35 @@ class Query:
         self.__limit = limit
         self.__offset = offset
         self.__delete = delete
-        self.__operators = {
-            "gt": ">",
-            "gte": ">=",
-            "lt": "<",
-            "lte": "<=",
-            "exact": "=",
-            "iexact": "=",
-            "contains": "LIKE",
-            "icontains": "ILIKE",
-            "startswith": "LIKE",
-            "istartswith": "ILIKE",
-            "endswith": "LIKE",
-            "iendswith": "ILIKE",
-            "isnull": "IS",
-            "in": "=",
-        }
+        self.__count = count
+        self.__exists = exists
+        self.__update = update if update else {}
+        self.__values = values if values else []
+        self.__values_columns = []
+        self.__related_columns = related_columns if related_columns else {}
+        self.__annotations = annotations if annotations else {}
+        self.__aggregate = aggregate
+        self.__after = after
+        self.__annotation_columns = []
+        # values(...).annotate(...) returns one row per group, count() has to count the groups.
+        self.__grouped_count = bool(count and self.__values and self.__annotations)
+        self.__operators = OPERATORS
         self.__params = []
-        self.__base_query = "SELECT {};" if not delete else "DELETE {};"
+        self.__param_plan = []
+        if delete:
+            self.__base_query = "DELETE {};"
+        elif self.__update:
+            self.__base_query = "UPDATE {};"
+        elif count and (limit is not None or offset or self.__grouped_count):
+            self.__base_query = "SELECT COUNT(*) FROM (SELECT {}) AS count_query;"
+        else:
+            self.__base_query = "SELECT {};"
         self.__from_query = ""
         self.__where_query = ""
+        self.__set_query = ""
         self.__order_by_query = ""
         self.__limit_offset_query = ""
+        self.__group_by_query = ""
         self.__column_query = ""
         self.__proxy_name_count = -1
         self.__base_table_proxy = self.generate_table_name_proxy()
@@ -106,13 +262,13 @@ class Query:
                 "fk_table_name": "{}".format(fk_table_class.get_full_table_name()),
                 "base_table_name": "{}".format(base_table_class.get_full_table_name()),
                 "key": key,
-                "fk_table_pk": fk_table_class.get_pk_name(),
-                "fk_columns": fk_table_class.get_column_names(),
+                "fk_table_pk": fk_table_class._meta.pk_name,
+                "fk_columns": fk_table_class._meta.column_names,
                 "fk_table_class": fk_table_class,
                 "base_table_class": base_table_class
             }
         }
-        fk_details_key = (join_data["details"]["fk_table_name"], join_data["details"]["base_table_name"], key)
+        fk_details_key = (join_data["details"]["fk_table_name"], join_data["details"]["base_table_name"], key, last_proxy)
         if avoid_duplicates and fk_details_key in self.__join_tables_involved:
             return self.__join_tables_involved[fk_details_key]
         else:
@@ -127,18 +283,14 @@ class Query:
         if key == "pk":
             key = self.__pk
         key = "{}.{}".format(table_proxy_name, key)
+        self.__params.extend(condition_params(condition, value))
         if condition == "=":
-            self.__params.append(value)
             return "{key}=%s".format(key=key)
         if condition == "in":
-            if isinstance(value, list):
-                self.__params.append(value)
-                return "{key} {operation} ANY(%s)".format(
-                    key=key,
-                    operation=self.__operators[condition]
-                )
-            else:
-                raise InvalidQueryException("Value should be a list.")
+            return "{key} {operation} ANY(%s)".format(
+                key=key,
+                operation=self.__operators[condition]
+            )
         if condition == "isnull":
             base = "{key} {operation}".format(
                 key=key,
@@ -146,101 +298,148 @@ class Query:
             )
             return "{} NULL".format(base) if value else "{} NOT NULL".format(base)
         if condition == "iexact":
-            self.__params.append(value)
             return "LOWER({key}){operation}LOWER(%s)".format(
                 key=key,
                 operation=self.__operators[condition],
             )
         if condition in ("contains", "icontains", "startswith", "istartswith", "endswith", "iendswith"):
-            if condition == "contains" or condition == "icontains":
-                self.__params.append("%{}%".format(value))
-            elif condition == "startswith" or condition == "istartswith":
-                self.__params.append("{}%".format(value))
-            elif condition == "endswith" or condition == "iendswith":
-                self.__params.append("%{}".format(value))
             return "{key} {operation} %s".format(
                 key=key,
                 operation=self.__operators[condition],
             )
-        self.__params.append(value)
         return "{key}{operation}%s".format(
             key=key,
             operation=self.__operators[condition],
         )
 
-    def __change_to_sql_conditions(self, key, value):
-        key_splits = key.split(LOGICAL_SEPARATOR)
-        if len(key_splits) == 1:
-            return self.__logical_conditions(
-                key=key_splits[0],
-                value=value,
-                condition="="
-            )
-        else:
-            proxy = None
-            if key_splits[-1] in self.__operators.keys():
-                condition = key_splits[-1]
-                key = key_splits[-2]
-                fk_fields = key_splits[:-2]
-                if not fk_fields:
-                    return self.__logical_conditions(
-                        key=key,
-                        value=value,
-                        condition=condition
-                    )
-            else:
-                key = key_splits[-1]
-                condition = "="
-                fk_fields = key_splits[:-1]
-
-            if fk_fields:
-                table_class = self.__table_class
-                for fk in fk_fields:
-                    fk_table_class = getattr(table_class.__dict__[fk], "table_name")
-                    proxy = self.__update_join_tables_involved(
-                        base_table_class=table_class,
-                        fk_table_class=fk_table_class,
-                        key=fk,
-                        last_proxy=proxy
-                    )
-                    table_class = fk_table_class
-
-            return self.__logical_conditions(
-                key=key,
-                value=value,
-                condition=condition,
-                table_proxy_name=proxy
+    def __change_to_sql_conditions(self, source, key, value):
+        fk_fields, column, condition = split_lookup(key)
+        self.__param_plan.append((source, key, condition))
+        proxy = None
+        table_class = self.__table_class
+        for fk in fk_fields:
+            fk_table_class = table_class._meta.foreign_keys[fk].table_name
+            proxy = self.__update_join_tables_involved(
+                base_table_class=table_class,
+                fk_table_class=fk_table_class,
+                key=fk,
+                last_proxy=proxy
             )
+            table_class = fk_table_class
+        return self.__logical_conditions(
+            key=column,
+            value=value,
+            condition=condition,
+            table_proxy_name=proxy
+        )
 
     def __create_where_query(self):
         filter_query = ""
         if self.__or_filter_dict:
             filter_query = "( {} )".format(" OR ".join([
-                self.__change_to_sql_conditions(k, v)
+                self.__change_to_sql_conditions("or_filter", k, v)
                 for k, v in self.__or_filter_dict.items()]))
         if self.__filter_dict:
             if filter_query:
                 filter_query += " AND "
             filter_query += " AND ".join([
-                self.__change_to_sql_conditions(k, v)
+                self.__change_to_sql_conditions("filter", k, v)
                 for k, v in self.__filter_dict.items()])
         if self.__exclude_dict:
             if filter_query:
                 filter_query += " AND "
             filter_query += "NOT "
             filter_query += " AND NOT ".join([
-                self.__change_to_sql_conditions(k, v)
+                self.__change_to_sql_conditions("exclude", k, v)
                 for k, v in self.__exclude_dict.items()])
+        if self.__after is not None:
+            if filter_query:
+                filter_query += " AND "
+            filter_query += self.__keyset_condition()
         if filter_query:
             filter_query = " WHERE {}".format(filter_query)
         self.__where_query = filter_query
 
+    def __keyset_condition(self):
+        directions = set(self.__order_dict.values())
+        if len(directions) != 1:
+            raise InvalidQueryException("Keyset pagination needs the same direction for every ordering column.")
+        if len(self.__after) != len(self.__order_dict):
+            raise InvalidQueryException("Keyset values do not match the ordering columns.")
+        fields = self.__table_class._meta.fields
+        self.__params.extend(self.__after)
+        self.__param_plan.append(("after", None, None))
+        return "({}) {} ({})".format(
+            ", ".join(["{}.{}".format(self.__base_table_proxy, k) for k in self.__order_dict]),
+            "<" if directions == {"DESC"} else ">",
+            ", ".join(["%s::{}".format(fields[k].cast_type) for k in self.__order_dict])
+        )
+
+    def __projection(self, columns):
+        if self.__count:
+            return "COUNT(*)" if self.__base_query == "SELECT {};" else "1"
+        if self.__exists:
+            return "1"
+        if self.__aggregate:
+            return ", ".join(self.__annotation_columns)
+        return ", ".join(list(columns) + self.__annotation_columns)
+
+    def __resolve_column(self, path):
+        fk_fields = path.split(LOGICAL_SEPARATOR)
+        column = fk_fields.pop()
+        proxy = None
+        table_class = self.__table_class
+        for fk in fk_fields:
+            if fk not in table_class._meta.foreign_keys:
+                raise InvalidQueryException("Foreign key not found: {}".format(fk))
+            fk_table_class = table_class._meta.foreign_keys[fk].table_name
+            proxy = self.__update_join_tables_involved(
+                base_table_class=table_class,
+                fk_table_class=fk_table_class,
+                key=fk,
+                last_proxy=proxy,
+                avoid_duplicates=True
+            )
+            table_class = fk_table_class
+        if column == "pk":
+            column = table_class._meta.pk_name
+        if column not in table_class._meta.column_set:
+            raise InvalidQueryException("Column not found: {}".format(path))
+        return "{}.{}".format(proxy or self.__base_table_proxy, column)
+
+    def __process_values(self):
+        if not self.__values or (self.__count and not self.__grouped_count) or self.__exists or self.__delete or self.__update:
+            return
+        for path in self.__values:
+            self.__values_columns.append(self.__resolve_column(path))
+
+    def __process_annotations(self):
+        if not self.__annotations or (self.__count and not self.__grouped_count) or self.__exists or self.__delete or self.__update:
+            return
+        for alias, aggregate in self.__annotations.items():
+            column = aggregate.field if aggregate.field == "*" else self.__resolve_column(aggregate.field)
+            self.__annotation_columns.append('{} AS "{}"'.format(aggregate.as_sql(column), alias))
+
+    def __create_group_by_query(self):
+        if not self.__annotation_columns or self.__aggregate:
+            return
+        if self.__values_columns:
+            columns = self.__values_columns
+        else:
+            columns = ["{}.{}".format(self.__base_table_proxy, self.__pk)] + [
+                "{}.{}".format(proxy, details["details"]["fk_table_pk"])
+                for proxy, details in self.__table_details.items()
+            ]
+        self.__group_by_query = " GROUP BY {}".format(", ".join(columns))
+
     def __process_select_related(self):
+        if self.__count or self.__exists or self.__delete or self.__update or self.__values or self.__aggregate:
+            return
         for fk_item in set(self.__select_related):
             proxy = None
             parent_class = self.__table_class
             for fk in fk_item.split("__"):
-                fk_table_class = getattr(parent_class.__dict__[fk], "table_name")
+                fk_table_class = parent_class._meta.foreign_keys[fk].table_name
                 proxy = self.__update_join_tables_involved(
                     base_table_class=parent_class,
                     fk_table_class=fk_table_class,
@@ -250,45 +449,66 @@ class Query:
                 )
                 parent_class = fk_table_class
 
+    def __create_set_query(self):
+        if not self.__update:
+            return
+        assignments = []
+        for column, value in self.__update.items():
+            assignments.append('"{}"=%s'.format(column))
+            self.__params.append(value)
+            self.__param_plan.append(("update", column, None))
+        self.__set_query = " SET {}".format(", ".join(assignments))
+
     def __switch_to_join_query(self):
-        if self.__delete:
-            from_query = "FROM {} AS {} USING ".format(
-                self.__full_table_name,
-                self.__base_table_proxy
+        join_query = ""
+        columns = ["{}.{}".format(self.__base_table_proxy, i) for i in self.__table_columns]
+        paths = {self.__base_table_proxy: ""}
+
+        for proxy_name, table_details in self.__table_details.items():
+            parent_path = paths[table_details["parent_proxy"]]
+            path = table_details["details"]["key"]
+            if parent_path:
+                path = parent_path + LOGICAL_SEPARATOR + path
+            paths[proxy_name] = path
+            fk_columns = self.__related_columns.get(path, table_details["details"]["fk_columns"])
+            columns += ["{}.{}".format(proxy_name, j) for j in fk_columns]
+
+            fk_table = "{} AS {}".format(
+                table_details["details"]["fk_table_name"],
+                proxy_name
             )
-            fk_tables = []
-            for proxy, table_details in self.__table_details.items():
-                fk_tables.append("{} AS {}".format(
-                    table_details["details"]["fk_table_name"],
-                    proxy
-                ))
-            self.__from_query = from_query + ", ".join(fk_tables)
-        else:
-            join_query = ""
-            columns = ["{}.{}".format(self.__base_table_proxy, i) for i in self.__table_class.get_column_names()]
-
-            for proxy_name, table_details in self.__table_details.items():
-                columns += ["{}.{}".format(proxy_name, j) for j in table_details["details"]["fk_columns"]]
-
-                fk_table = "{} AS {}".format(
-                    table_details["details"]["fk_table_name"],
-                    proxy_name
-                )
-                on_join = "{}.{}={}.{}".format(
-                    proxy_name,
-                    table_details["details"]["fk_table_pk"],
-                    table_details["parent_proxy"],
-                    table_details["details"]["key"]
-                )
-                join_query += " LEFT JOIN " + fk_table + " ON " + on_join
+            on_join = "{}.{}={}.{}".format(
+                proxy_name,
+                table_details["details"]["fk_table_pk"],
+                table_details["parent_proxy"],
+                table_details["details"]["key"]
+            )
+            join_query += " LEFT JOIN " + fk_table + " ON " + on_join
 
-            self.__column_query = ", ".join(columns)
-            self.__from_query = "{} FROM {} AS {}{}".format(
-                self.__column_query,
-                self.__full_table_name,
+        if self.__delete or self.__update:
+            # The rows are selected with the same LEFT JOINs as a read, so NULL foreign keys match the same way.
+            if self.__delete:
+                self.__from_query = "FROM {}".format(self.__full_table_name)
+            else:
+                self.__from_query = "{}{}".format(self.__full_table_name, self.__set_query)
+            self.__where_query = " WHERE {0} IN (SELECT {1}.{0} FROM {2} AS {1}{3}{4})".format(
+                self.__pk,
                 self.__base_table_proxy,
-                join_query
+                self.__full_table_name,
+                join_query,
+                self.__where_query
             )
+            return
+
+        if self.__values_columns:
+            columns = self.__values_columns
+        self.__column_query = self.__projection(columns)
+        self.__from_query = "{} FROM {} AS {}{}".format(
+            self.__column_query,
+            self.__full_table_name,
+            self.__base_table_proxy,
+            join_query
+        )
 
     def __create_from_query(self):
         if self.__join_tables_involved:
@@ -300,8 +520,15 @@ class Query:
                     self.__full_table_name,
                     proxy_name
                 )
+            elif self.__update:
+                self.__from_query = "{} AS {}{}".format(
+                    self.__full_table_name,
+                    proxy_name,
+                    self.__set_query
+                )
             else:
-                self.__column_query = ", ".join(["{}.{}".format(proxy_name, i) for i in self.__table_columns])
+                columns = self.__values_columns or ["{}.{}".format(proxy_name, i) for i in self.__table_columns]
+                self.__column_query = self.__projection(columns)
                 self.__from_query = "{} FROM {}".format(
                     self.__column_query,
                     "{} AS {}".format(self.__full_table_name, proxy_name)
@@ -309,27 +536,109 @@ class Query:
 
     def __create_order_by_query(self):
         order_query = ""
-        if not self.__delete:
+        grouped = self.__aggregate or (self.__annotation_columns and self.__values_columns and not self.__ordered)
+        if not (self.__delete or self.__update or self.__count or self.__exists or grouped):
             if self.__order_dict:
-                order_query = ", ".join(
-                    ["{}.{} {}".format(self.__base_table_proxy, k, v) for k, v in self.__order_dict.items()])
+                order_query = ", ".join([
+                    '"{}" {}'.format(k, v) if k in self.__annotations else
+                    "{}.{} {}".format(self.__base_table_proxy, k, v)
+                    for k, v in self.__order_dict.items()
+                ])
             if order_query:
                 order_query = " ORDER BY {}".format(order_query)
         self.__order_by_query = order_query
 
+    def __limit_value(self):
+        if self.__exists:
+            return 1 if self.__limit is None else min(self.__limit, 1)
+        return self.__limit
+
     def __create_limit_offset_query(self):
         query = ""
-        if self.__limit is not None:
-            query += " LIMIT {}".format(self.__limit)
+        if self.__exists or self.__limit is not None:
+            query += " LIMIT %s"
+            self.__params.append(self.__limit_value())
+            self.__param_plan.append(("limit", None, None))
         if self.__offset:
-            query += " OFFSET {}".format(self.__offset)
+            query += " OFFSET %s"
+            self.__params.append(self.__offset)
+            self.__param_plan.append(("offset", None, None))
         self.__limit_offset_query = query
 
+    def __cache_key(self):
+        def shape(lookups):
+            return tuple(
+                (k, bool(v)) if k.endswith(LOGICAL_SEPARATOR + "isnull") else k
+                for k, v in lookups.items()
+            )
+        return (
+            self.__table_class,
+            self.__schema,
+            tuple(self.__table_columns),
+            shape(self.__or_filter_dict),
+            shape(self.__filter_dict),
+            shape(self.__exclude_dict),
+            tuple(self.__select_related),
+            tuple(self.__order_dict.items()),
+            self.__limit is not None,
+            bool(self.__offset),
+            self.__delete,
+            self.__count,
+            self.__exists,
+            tuple(self.__update),
+            tuple(self.__values),
+            tuple(sorted(self.__related_columns.items())),
+            tuple((k, v.shape) for k, v in self.__annotations.items()),
+            self.__aggregate,
+            self.__after is not None,
+            self.__ordered
+        )
+
+    def __build_params(self, param_plan):
+        sources = {
+            "or_filter": self.__or_filter_dict,
+            "filter": self.__filter_dict,
+            "exclude": self.__exclude_dict
+        }
+        params = []
+        for source, key, condition in param_plan:
+            if source == "update":
+                params.append(self.__update[key])
+            elif source == "after":
+                params.extend(self.__after)
+            elif source == "limit":
+                params.append(self.__limit_value())
+            elif source == "offset":
+                params.append(self.__offset)
+            else:
+                params.extend(condition_params(condition, sources[source][key]))
+        return params
+
+    def compile(self):
+        key = self.__cache_key()
+        compiled = QUERY_CACHE.get(key)
+        if compiled is not None:
+            return compiled, self.__build_params(compiled.param_plan)
+        sql_query, params, column_query, table_details, base_table_proxy = self.query()
+        compiled = CompiledQuery(
+            sql=sql_query,
+            column_query=column_query,
+            table_details=table_details,
+            base_table_proxy=base_table_proxy,
+            param_plan=tuple(self.__param_plan)
+        )
+        QUERY_CACHE.set(key, compiled)
+        return compiled, params
+
     def query(self):
 
+        self.__create_set_query()
         self.__create_where_query()
+        self.__process_values()
+        self.__process_annotations()
         self.__process_select_related()
         self.__create_from_query()
+        self.__create_group_by_query()
 
         self.__create_order_by_query()
         self.__create_limit_offset_query()
@@ -337,6 +646,7 @@ class Query:
         query = (
             self.__from_query +
             self.__where_query +
+            self.__group_by_query +
             self.__order_by_query +
             self.__limit_offset_query
         )
@@ -1,5 +1,9 @@
 from sql_orm import postgresql, DATABASE_TYPES, SQLException, Table
 from sql_orm.postgresql import sql
+from sql_orm.postgresql import datatypes
+from sql_orm.postgresql import aio
+from sql_orm.postgresql import cache
+from sql_orm.postgresql.session import get_session
 from sql_orm.postgresql.objects import Objects
 
 
@@ -7,6 +11,7 @@ class PostgreSQLTable(Table):
 
     _schema = "public"
     objects = Objects()
+    aobjects = aio.AsyncObjects()
 
     def __init__(self, **kwargs):
         super().__init__(database_type=DATABASE_TYPES["PostgreSQL"], **kwargs)
@@ -26,7 +31,7 @@ class PostgreSQLTable(Table):
     @classmethod
     def __create_table(cls):
         add_primary_key = ""
-        for k, v in cls._get_column_fields().items():
+        for k, v in cls._meta.fields.items():
             if v.primary_key:
                 if not add_primary_key:
                     add_primary_key = "{name} {field_type} {properties}".format(
@@ -48,7 +53,7 @@ class PostgreSQLTable(Table):
     def __create_columns(cls):
         schema = cls.get_schema()
         table_name = cls.get_table_name()
-        for k, v in cls._get_column_fields().items():
+        for k, v in cls._meta.fields.items():
             if v.primary_key:
                 continue
             if v.database_type != DATABASE_TYPES["PostgreSQL"]:
@@ -59,7 +64,7 @@ class PostgreSQLTable(Table):
     def __create_meta_properties(cls):
         meta_queries = []
         meta_field = cls._get_meta_field()
-        column_names = cls.get_column_names()
+        column_names = cls._meta.column_set
         if meta_field:
             unique_together = meta_field.__dict__.get("unique_together", ())
             for i in unique_together:
@@ -69,13 +74,16 @@ class PostgreSQLTable(Table):
                 meta_queries.append(sql.add_unique_together().format(
                     schema=cls.get_schema(),
                     table_name=cls.get_table_name(),
-                    constraint_name="{}_uniq".format("_".join(i)),
-                    columns=",".join(['"{}"'.format(col for col in i)])
+                    constraint_name="{}_{}_uniq".format(cls.get_table_name(), "_".join(i)),
+                    old_constraint_name="{}_uniq".format("_".join(i)),
+                    columns=",".join(['"{}"'.format(col) for col in i])
                 ))
         return meta_queries
 
     @classmethod
     def get_value_or_object_pk(cls, value):
+        if isinstance(value, datatypes.ForeignKeyField):
+            return value.get_value()
         return getattr(value, "pk") if hasattr(value, "pk") else value
 
     def __get_field_value(self, field_name):
@@ -101,55 +109,101 @@ class PostgreSQLTable(Table):
 
     @property
     def pk(self):
-        for k, v in self.__class__._get_column_fields().items():
-            if v.primary_key:
-                return getattr(self, k)
+        pk_name = self.__class__._meta.pk_name
+        if pk_name:
+            return getattr(self, pk_name)
 
     @classmethod
     def get_pk_name(cls):
-        for k, v in cls._get_column_fields().items():
-            if v.primary_key:
-                return k
+        return cls._meta.pk_name
 
-    def _sql_save(self, commit=True):
+    def _save_query(self, update_fields=None):
+        meta = self.__class__._meta
         if getattr(self, "pk"):
-            pk_name = self.__class__.get_pk_name()
-            column_names = [i for i in self.__class__.get_column_names() if i != pk_name]
+            if update_fields is None:
+                dirty_fields = self.get_dirty_fields()
+                column_names = [i for i in meta.non_pk_column_names if i in dirty_fields]
+            else:
+                column_names = list(update_fields)
+                for i in column_names:
+                    if i not in meta.column_set or i == meta.pk_name:
+                        raise SQLException("Column cannot be updated: {}".format(i))
+            if not column_names:
+                return None
             params = [self.__get_field_value(i) for i in column_names] + [self.pk]
             query = sql.update_table_row().format(
                 schema=self.__class__.get_schema(),
-                table_name=self.__class__.get_table_name(),
-                set_key_value=", ".join(['"{}"=%s'.format(i) for i in column_names]),
-                condition='"{}"=%s'.format(pk_name)
+                table_name=meta.table_name,
+                set_key_value=", ".join(["{}=%s".format(meta.quoted_column_names[i]) for i in column_names]),
+                condition="{}=%s".format(meta.quoted_column_names[meta.pk_name])
             )
-            with postgresql.PostgreSQL() as pgsql:
-                pgsql.query(query, params=params)
-                pgsql.commit()
         else:
-            column_names = ['"{}"'.format(i) for i in self.__class__.get_column_names() if i != "id"]
+            column_names = [i for i in meta.column_names if i != "id"]
             params = [self.__get_field_value(i) for i in column_names]
             query = sql.insert_table_row().format(
                 schema=self.__class__.get_schema(),
-                table_name=self.__class__.get_table_name(),
-                column_names=", ".join(column_names),
+                table_name=meta.table_name,
+                column_names=", ".join([meta.quoted_column_names[i] for i in column_names]),
                 column_values=", ".join(["%s"] * len(column_names))
             )
+        return query, params, column_names
+
+    def _sql_save(self, commit=True, update_fields=None):
+        statement = self._save_query(update_fields=update_fields)
+        if statement is None:
+            return
+        query, params, column_names = statement
+        if getattr(self, "pk"):
+            with postgresql.PostgreSQL() as pgsql:
+                pgsql.query(query, params=params)
+                pgsql.commit()
+            self._clear_dirty_fields(column_names)
+            cache.invalidate(self.__class__)
+        else:
             obj_id = None
             if commit:
                 with postgresql.PostgreSQL() as pgsql:
                     pgsql.query(query, params=params)
                     obj_id = pgsql.fetchone()[0]
                     pgsql.commit()
+                self._clear_dirty_fields()
+                cache.invalidate(self.__class__)
             self.__dict__["id"] = obj_id
 
-    def save(self, commit=True):
-        self._sql_save(commit=commit)
+    def save(self, commit=True, update_fields=None):
+        session = get_session()
+        if session is not None and commit:
+            session.add(self, update_fields=update_fields)
+            return
+        self._sql_save(commit=commit, update_fields=update_fields)
 
     def delete(self):
-        if getattr(self, "pk"):
+        session = get_session()
+        if session is not None:
+            session.delete(self)
+        elif getattr(self, "pk"):
             self.__class__.objects.filter(pk=self.pk).delete()
         else:
             raise SQLException("Missing primary key for the given object.")
 
+    async def asave(self, update_fields=None):
+        statement = self._save_query(update_fields=update_fields)
+        if statement is None:
+            return
+        query, params, column_names = statement
+        created = not getattr(self, "pk")
+        async with aio.AsyncPostgreSQL() as pgsql:
+            await pgsql.query(query, params=params)
+            if created:
+                self.__dict__["id"] = pgsql.fetchone()[0]
+        self._clear_dirty_fields(None if created else column_names)
+        cache.invalidate(self.__class__)
+
+    async def adelete(self):
+        if getattr(self, "pk"):
+            await self.__class__.aobjects.filter(pk=self.pk).delete()
+        else:
+            raise SQLException("Missing primary key for the given object.")
+
     def as_dict(self):
-        return {k: self.__dict__.get(k) for k in self.__class__.get_column_names()}
\ No newline at end of file
+        return {k: self.__dict__.get(k) for k in self.__class__._meta.column_names}
\ No newline at end of file
@@ -1,10 +1,21 @@
 from db_models.models import *
 from migrate import run_migrations
+from sql_orm import postgresql, identity_map, get_identity_map, atomic, session, SQLException
+from sql_orm.postgresql import sql, aio, instrumentation, cache, plans
+from sql_orm.postgresql.objects import QueryException, MultipleObjectsFound
+from sql_orm.postgresql.aggregates import Sum, Avg, Min, Max, Count
 from datetime import datetime, timedelta
+import asyncio
+import contextlib
+import psycopg2
+import threading
+import time
 import unittest
+from unittest import mock
 
 
 def create_objects():
+    ExchangeRate.objects.delete()
     InterBankTransaction.objects.delete()
     InterBankStatus.objects.delete()
     Transactions.objects.delete()
@@ -117,6 +128,28 @@ class TestORMMethods(unittest.TestCase):
         self.assertEqual(obj.code, "JPN")
         self.assertEqual(created, False)
 
+    def test_bulk_create_returning_ids(self):
+        currencies = [Currency(code="AA{}".format(i)) for i in range(5)]
+        ids = Currency.objects.bulk_create(currencies, batch_size=2, return_ids=True)
+        self.assertEqual(len(set(ids)), 5)
+        self.assertEqual([i.id for i in currencies], ids)
+        self.assertEqual([Currency.objects.get(pk=i).code for i in ids], ["AA{}".format(i) for i in range(5)])
+        Transactions.objects.bulk_create([
+            {
+                "date_of_entry": datetime.now().date(),
+                "datetime_of_entry": None,
+                "amount": 7.5,
+                "status": True,
+                "bank": Bank.objects.get(name="Third Bank name")
+            }
+        ])
+        transaction = Transactions.objects.get(amount=7.5)
+        self.assertEqual(transaction.bank.name, "Third Bank name")
+        self.assertIsNone(transaction.datetime_of_entry)
+        transaction.delete()
+        Currency.objects.filter(id__in=ids).delete()
+        self.assertEqual(Currency.objects.filter(code__startswith="AA").count(), 0)
+
     def test_bulk_object_creation(self):
         Currency.objects.bulk_create([
             {
@@ -135,8 +168,44 @@ class TestORMMethods(unittest.TestCase):
         currencies = sorted([i.code for i in Currency.objects.all()])
         self.assertEqual(currencies, ['EUR', 'GBP', 'INR', 'JPN', 'USD'])
 
+    def test_connection_pool(self):
+        with postgresql.PostgreSQL() as pgsql:
+            connection = pgsql.connection
+        with postgresql.PostgreSQL() as pgsql:
+            self.assertIs(pgsql.connection, connection)
+        pool = postgresql.ConnectionPool(min_size=0, max_size=1, timeout=0.1, **postgresql.get_credentials())
+        with postgresql.PostgreSQL(pool=pool):
+            self.assertEqual(pool.size, 1)
+            with self.assertRaises(postgresql.PoolException):
+                postgresql.PostgreSQL(pool=pool)
+        self.assertEqual(pool.idle, 1)
+        with mock.patch.object(postgresql.PooledConnection, "cursor", side_effect=psycopg2.InterfaceError):
+            with self.assertRaises(psycopg2.InterfaceError):
+                postgresql.PostgreSQL(pool=pool)
+        self.assertEqual((pool.size, pool.idle), (1, 1))
+        pool.closeall()
+
     def test_query_count(self):
         self.assertEqual(Bank.objects.count(), 3)
+        self.assertEqual(Transactions.objects.filter(bank__currency__code="EUR").count(), 2)
+        self.assertEqual(Transactions.objects.select_related().count(), 5)
+        self.assertEqual(Transactions.objects.order_by("amount")[1:3].count(), 2)
+        self.assertEqual(Transactions.objects.order_by("amount")[4:].count(), 1)
+
+    def test_query_exists(self):
+        self.assertTrue(Transactions.objects.filter(bank__currency__code="EUR").exists())
+        self.assertFalse(Transactions.objects.filter(bank__currency__code="XXX").exists())
+        self.assertFalse(Transactions.objects.order_by("amount")[5:].exists())
+
+    def test_query_deletion_with_join(self):
+        currency = Currency.objects.create(code="DEL")
+        bank = Bank.objects.create(name="Deleted Bank name", currency=currency)
+        Transactions.objects.create(date_of_entry=datetime.now().date(), amount=50, bank=bank)
+        Transactions.objects.filter(bank__currency__code="DEL").delete()
+        self.assertEqual(Transactions.objects.filter(bank__currency__code="DEL").count(), 0)
+        self.assertEqual(Transactions.objects.count(), 5)
+        bank.delete()
+        currency.delete()
 
     def test_query_order_by(self):
         all_currencies_1 = [i.code for i in Currency.objects.order_by('code')]
@@ -149,6 +218,17 @@ class TestORMMethods(unittest.TestCase):
         currency_2 = Currency.objects.order_by('-code')[3]
         self.assertEqual(currency_1.code, "INR")
         self.assertEqual(currency_2.code, "GBP")
+        with self.assertRaises(IndexError):
+            Currency.objects.order_by('-code')[100]
+
+    def test_query_first_last(self):
+        self.assertEqual(Currency.objects.order_by('code').first().code, "EUR")
+        self.assertEqual(Currency.objects.order_by('code').last().code, "USD")
+        self.assertEqual(Transactions.objects.order_by(("amount", "id")).last().amount, 3)
+        self.assertEqual(Transactions.objects.last().id, max(i.id for i in Transactions.objects.all()))
+        self.assertIsNone(Currency.objects.filter(code="XXX").first())
+        with self.assertRaises(MultipleObjectsFound):
+            Transactions.objects.get(bank__currency__code="USD")
 
     def test_query_slicing(self):
         all_currencies_1 = [i.code for i in Currency.objects.order_by('-code')[:2]]
@@ -232,6 +312,43 @@ class TestORMMethods(unittest.TestCase):
         self.assertEqual(inter_bank_trans_2.amount, 300)
         self.assertEqual([i.amount for i in inter_bank_trans_3], [100, 200, 300])
 
+    def test_lazy_foreign_key_cache(self):
+        trans_1, trans_2 = Transactions.objects.filter(amount__in=[1, 2]).order_by("amount")
+        bank = trans_1.bank.get_related_object()
+        self.assertEqual(trans_1.bank.name, "Second Bank name")
+        self.assertIs(trans_1.bank.get_related_object(), bank)
+        self.assertIsNot(trans_2.bank.get_related_object(), bank)
+        trans_1.bank = Bank.objects.get(name="Third Bank name")
+        self.assertEqual(trans_1.bank.name, "Third Bank name")
+        self.assertEqual(trans_1.get_dirty_fields(), {"bank"})
+        with identity_map():
+            trans_1, trans_2 = Transactions.objects.filter(amount__in=[1, 2]).order_by("amount")
+            self.assertIs(trans_1.bank.get_related_object(), trans_2.bank.get_related_object())
+            trans_3, trans_4 = Transactions.objects.filter(amount__in=[1, 2]).prefetch_related("bank")
+            self.assertIs(trans_3.bank, trans_1.bank.get_related_object())
+        self.assertIsNone(get_identity_map())
+
+    def test_query_prefetch_related(self):
+        trans_1 = Transactions.objects.all().prefetch_related("bank__currency").order_by("amount")
+        trans_2 = [i for i in Transactions.objects.all().prefetch_related("bank", "bank__currency").order_by("amount")]
+        inter_bank_1 = InterBankTransaction.objects.prefetch_related("banks_involved__receiver").order_by("amount")
+
+        self.assertEqual(
+            [(i.bank.name, i.bank.currency.code) for i in trans_1],
+            [('First Bank name', 'USD'), ('First Bank name', 'USD'), ('Second Bank name', 'EUR'),
+             ('Second Bank name', 'EUR'), ('Third Bank name', 'INR')]
+        )
+        self.assertIsInstance(trans_2[0].bank, Bank)
+        self.assertIsInstance(trans_2[0].bank.currency, Currency)
+        self.assertIs(trans_2[0].bank, trans_2[1].bank)
+        self.assertEqual(trans_2[0].get_dirty_fields(), set())
+        self.assertEqual(
+            [i.banks_involved.receiver.name for i in inter_bank_1],
+            ['Second Bank name', 'Second Bank name', 'Third Bank name']
+        )
+        with self.assertRaises(QueryException):
+            Transactions.objects.prefetch_related("amount")
+
     def test_query_select_related(self):
         trans_1 = Transactions.objects.all().select_related().order_by("amount")
         trans_2 = Transactions.objects.filter(amount__lt=3).select_related("bank__currency").order_by("amount")
@@ -250,6 +367,537 @@ class TestORMMethods(unittest.TestCase):
             [('First Bank name', 'Second Bank name'), ('Second Bank name', 'Third Bank name')]
         )
 
+    def test_query_values(self):
+        self.assertEqual(
+            [i for i in Transactions.objects.filter(amount__lt=3).order_by("amount").values("amount", "bank__currency__code")],
+            [{"amount": -2, "bank__currency__code": "USD"}, {"amount": -1, "bank__currency__code": "USD"},
+             {"amount": 1, "bank__currency__code": "EUR"}, {"amount": 2, "bank__currency__code": "EUR"}]
+        )
+        self.assertEqual(
+            [i for i in InterBankStatus.objects.order_by("id").values_list("depositor__currency__code", "receiver__currency__code")],
+            [("USD", "EUR"), ("EUR", "INR")]
+        )
+        self.assertEqual(
+            sorted(Bank.objects.filter(currency__code__in=["USD", "INR"]).values_list("name", flat=True)),
+            ["First Bank name", "Third Bank name"]
+        )
+        self.assertEqual(Currency.objects.values("code").get(code="EUR"), {"code": "EUR"})
+        self.assertEqual(sorted(Currency.objects.values()[0]), ["code", "id"])
+        with self.assertRaises(QueryException):
+            Bank.objects.values_list("name", "id", flat=True)
+
+    def test_query_aggregation(self):
+        self.assertEqual(
+            Transactions.objects.aggregate(total=Sum("amount"), n=Count("id"), low=Min("amount"), high=Max("amount")),
+            {"total": 3, "n": 5, "low": -2, "high": 3}
+        )
+        self.assertEqual(Transactions.objects.filter(bank__currency__code="EUR").aggregate(avg=Avg("amount")), {"avg": 1.5})
+        self.assertEqual(Bank.objects.aggregate(n=Count("currency__code", distinct=True)), {"n": 3})
+        self.assertEqual(
+            [i for i in Transactions.objects.values("bank__currency__code").annotate(total=Sum("amount"), n=Count()).order_by(("-n", "total"))],
+            [{"bank__currency__code": "USD", "total": -3, "n": 2}, {"bank__currency__code": "EUR", "total": 3, "n": 2},
+             {"bank__currency__code": "INR", "total": 3, "n": 1}]
+        )
+        # An explicit order_by("id") has the same order_dict as the default ordering but compiles to other SQL.
+        with self.assertRaises(psycopg2.errors.GroupingError):
+            [i for i in Transactions.objects.values("bank__currency__code").annotate(n=Count()).order_by("id")]
+        groups = [i for i in Transactions.objects.values("bank__currency__code").annotate(n=Count())]
+        self.assertEqual(
+            sorted((i["bank__currency__code"], i["n"]) for i in groups),
+            [("EUR", 2), ("INR", 1), ("USD", 2)]
+        )
+        self.assertEqual(Transactions.objects.values("bank__currency__code").annotate(n=Count()).count(), 3)
+        self.assertEqual(Transactions.objects.values("bank__currency__code").annotate(n=Count())[:2].count(), 2)
+        self.assertEqual(Transactions.objects.values("bank__currency__code").count(), 5)
+        banks = [(i.name, i.n) for i in Bank.objects.select_related("currency").annotate(n=Count("id")).order_by("name")]
+        self.assertEqual(banks, [("First Bank name", 1), ("Second Bank name", 1), ("Third Bank name", 1)])
+        with self.assertRaises(QueryException):
+            Transactions.objects.annotate(amount=Sum("amount"))
+        with self.assertRaises(QueryException):
+            Transactions.objects.all()[1:3].aggregate(total=Sum("amount"))
+
+    def test_query_paginate_by_key(self):
+        pages = []
+        token = None
+        while True:
+            page, token = Transactions.objects.filter(amount__lt=10).paginate_by_key(("-amount", ), after=token, page_size=2)
+            pages.append([i.amount for i in page])
+            if token is None:
+                break
+        self.assertEqual(pages, [[3, 2], [1, -1], [-2]])
+        page, token = Transactions.objects.paginate_by_key("amount", page_size=5)
+        self.assertEqual(len(page), 5)
+        self.assertIsNone(token)
+        with self.assertRaises(QueryException):
+            Transactions.objects.paginate_by_key(("amount", "-id"))
+        with self.assertRaises(QueryException):
+            Transactions.objects.paginate_by_key("amount", after="not a token")
+        with self.assertRaises(QueryException):
+            Transactions.objects.paginate_by_key(("datetime_of_entry", ))
+        with self.assertRaises(QueryException):
+            Transactions.objects.paginate_by_key(("amount", "bank"))
+
+    def test_async_queries(self):
+        async def run():
+            self.assertEqual(await Bank.aobjects.count(), 3)
+            self.assertTrue(await Transactions.aobjects.filter(bank__currency__code="EUR").exists())
+            bank = await Bank.aobjects.select_related("currency").get(name="First Bank name")
+            self.assertEqual(bank.currency.code, "USD")
+            self.assertEqual([i.code async for i in Currency.aobjects.filter(code__in=["EUR", "INR"]).order_by("code")], ["EUR", "INR"])
+            currency = await Currency.aobjects.create(code="ASY")
+            self.assertIsNotNone(currency.id)
+            currency.code = "ASZ"
+            await currency.asave()
+            self.assertEqual((await Currency.aobjects.get(pk=currency.id)).code, "ASZ")
+            ids = await Currency.aobjects.bulk_create([Currency(code="AS1"), {"code": "AS2"}])
+            self.assertEqual(len(ids), 2)
+            self.assertEqual(await Currency.aobjects.filter(code__startswith="AS").count(), 3)
+            await currency.adelete()
+            self.assertEqual(await Currency.aobjects.filter(code__startswith="AS").delete(), 2)
+            self.assertIsNone(await Currency.aobjects.filter(code="ASZ").first())
+            with self.assertRaises(TypeError):
+                [i for i in Currency.aobjects.all()]
+            self.assertEqual(await Bank.aobjects.filter(name="Third Bank name").update(name="Async Bank name"), 1)
+            self.assertEqual(await Bank.aobjects.filter(name="Async Bank name").count(), 1)
+            await Bank.aobjects.filter(name="Async Bank name").update(name="Third Bank name")
+            self.assertEqual(await Transactions.aobjects.aggregate(total=Sum("amount")), {"total": 3})
+            self.assertEqual((await Transactions.aobjects.order_by("amount").last()).amount, 3)
+            with self.assertRaises(TypeError):
+                Currency.aobjects.all()[0]
+            with self.assertRaises(QueryException):
+                Currency.aobjects.bulk_upsert([{"code": "ASX"}], conflict_fields=("code", ))
+            amounts = [i.amount async for i in Transactions.aobjects.select_related("bank").order_by("amount").aiterator(chunk_size=2)]
+            self.assertEqual(amounts, [-2, -1, 1, 2, 3])
+            async with contextlib.aclosing(Transactions.aobjects.order_by("amount").aiterator(chunk_size=2)) as rows:
+                async for _ in rows:
+                    break
+            self.assertEqual(aio.get_pool().idle, 1)
+            usd = await Currency.aobjects.get(code="USD")
+            rate, created = await ExchangeRate.aobjects.get_or_create(base=usd, quote="EUR", defaults={"rate": 0.9})
+            self.assertTrue(created)
+            same_rate, created = await ExchangeRate.aobjects.get_or_create(base=usd, quote="EUR", defaults={"rate": 0.5})
+            self.assertEqual((same_rate.id, float(same_rate.rate), created), (rate.id, 0.9, False))
+            rate, created = await ExchangeRate.aobjects.update_or_create(base=usd, quote="EUR", defaults={"rate": 0.7})
+            self.assertEqual((rate.id, float(rate.rate), created), (same_rate.id, 0.7, False))
+            await ExchangeRate.aobjects.delete()
+            plans.set_seq_scan_threshold(0)
+            try:
+                with self.assertNoLogs("sql_orm.plans", level="WARNING"):
+                    self.assertEqual(await Bank.aobjects.filter(name="First Bank name").count(), 1)
+            finally:
+                plans.set_seq_scan_threshold(None)
+            await aio.close_pool()
+        asyncio.run(run())
+
+    def test_atomic(self):
+        other_pool = postgresql.ConnectionPool(min_size=0, max_size=1, **postgresql.get_credentials())
+        with atomic():
+            Currency.objects.create(code="AT1")
+            Currency.objects.bulk_create([{"code": "AT2"}])
+            with postgresql.PostgreSQL() as pgsql_1, postgresql.PostgreSQL() as pgsql_2:
+                self.assertIs(pgsql_1.connection, pgsql_2.connection)
+            self.assertEqual(Currency.objects.filter(code__startswith="AT").count(), 2)
+            with postgresql.PostgreSQL(pool=other_pool) as pgsql:
+                pgsql.query("SELECT COUNT(*) FROM personal.currency WHERE code LIKE 'AT%%';")
+                self.assertEqual(pgsql.fetchone()[0], 0)
+            with self.assertRaises(ValueError):
+                with atomic():
+                    Currency.objects.create(code="AT3")
+                    raise ValueError
+            with atomic():
+                Currency.objects.create(code="AT4")
+        self.assertEqual(sorted(i.code for i in Currency.objects.filter(code__startswith="AT")), ["AT1", "AT2", "AT4"])
+        with self.assertRaises(ValueError):
+            with atomic():
+                Currency.objects.filter(code__startswith="AT").delete()
+                raise ValueError
+        self.assertEqual(Currency.objects.filter(code__startswith="AT").count(), 3)
+        Currency.objects.filter(code__startswith="AT").delete()
+        self.assertIsNone(postgresql.get_transaction())
+        other_pool.closeall()
+
+    def test_atomic_decorator_threads(self):
+        # The first thread leaves the shared decorator while the second one is still inside it.
+        second_entered, first_done = threading.Event(), threading.Event()
+        connections, errors = [], []
+
+        @atomic()
+        def create(code, wait_for):
+            Currency.objects.create(code=code)
+            with postgresql.PostgreSQL() as pgsql:
+                connections.append(pgsql.connection)
+            if code == "TH2":
+                second_entered.set()
+            wait_for.wait(10)
+
+        def run(code, wait_for, done):
+            try:
+                create(code, wait_for)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                done.set()
+
+        threads = [
+            threading.Thread(target=run, args=("TH1", second_entered, first_done)),
+            threading.Thread(target=run, args=("TH2", first_done, threading.Event()))
+        ]
+        threads[0].start()
+        while not connections:
+            time.sleep(0.01)
+        threads[1].start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertIsNot(connections[0], connections[1])
+        self.assertEqual(sorted(i.code for i in Currency.objects.filter(code__startswith="TH")), ["TH1", "TH2"])
+        Currency.objects.filter(code__startswith="TH").delete()
+
+    def test_session(self):
+        with session() as current:
+            currencies = [Currency.objects.create(code="SE{}".format(i)) for i in range(3)]
+            bank = Bank(name="Session Bank name", currency=currencies[0])
+            bank.save()
+            self.assertEqual(len(current), 4)
+            self.assertIsNone(bank.id)
+            current.flush()
+            self.assertEqual(len(current), 0)
+            self.assertEqual(Bank.objects.get(pk=bank.id).currency.code, "SE0")
+            currencies[1].code = "SE8"
+            currencies[1].save()
+            currencies[2].code = "SE9"
+            currencies[2].save()
+            currencies[0].save()
+            bank.delete()
+            self.assertEqual(len(current), 3)
+            self.assertEqual(Bank.objects.filter(name="Session Bank name").count(), 0)
+            self.assertEqual(len(current), 0)
+            pending = Currency(code="SE7")
+            pending.save()
+            pending.delete()
+        self.assertEqual(sorted(i.code for i in Currency.objects.filter(code__startswith="SE")), ["SE0", "SE8", "SE9"])
+        with self.assertRaises(ValueError):
+            with session():
+                for i in Currency.objects.filter(code__startswith="SE"):
+                    i.delete()
+                raise ValueError
+        self.assertEqual(Currency.objects.filter(code__startswith="SE").count(), 3)
+        with session():
+            for i in Currency.objects.filter(code__startswith="SE"):
+                i.delete()
+        self.assertEqual(Currency.objects.filter(code__startswith="SE").count(), 0)
+
+    def test_session_direct_writes(self):
+        with session():
+            currency = Currency.objects.create(code="SW2")
+            Bank.objects.bulk_create([{"name": "Session bulk bank", "currency": currency}])
+            ExchangeRate.objects.bulk_upsert([{"base": currency, "quote": "EUR", "rate": 1}])
+        self.assertEqual(Bank.objects.select_related("currency").get(name="Session bulk bank").currency.code, "SW2")
+        self.assertEqual(ExchangeRate.objects.filter(base__code="SW2").count(), 1)
+        ExchangeRate.objects.delete()
+        Bank.objects.filter(name="Session bulk bank").delete()
+        Currency.objects.filter(code="SW2").delete()
+
+    def test_session_insert_order(self):
+        with session():
+            currency = Currency(code="SW1")
+            bank = Bank(name="Session order bank", currency=currency)
+            bank.save()
+            currency.save()
+        self.assertEqual(Bank.objects.select_related("currency").get(name="Session order bank").currency.code, "SW1")
+        with self.assertRaises(SQLException):
+            with session():
+                bank = Bank(name="Session unsaved bank", currency=Currency(code="SW3"))
+                bank.save()
+        self.assertFalse(Bank.objects.filter(name="Session unsaved bank").exists())
+        Bank.objects.filter(name="Session order bank").delete()
+        Currency.objects.filter(code="SW1").delete()
+
+    def test_unique_together_migration(self):
+        def constraints():
+            with postgresql.PostgreSQL() as pgsql:
+                pgsql.query(
+                    "SELECT conname FROM pg_constraint WHERE conrelid = 'personal.exchangerate'::regclass "
+                    "AND contype = 'u' ORDER BY conname;"
+                )
+                return [i[0] for i in pgsql.fetchall()]
+
+        def add_old_constraint(drop_new):
+            with postgresql.PostgreSQL() as pgsql:
+                if drop_new:
+                    pgsql.query("ALTER TABLE personal.exchangerate DROP CONSTRAINT exchangerate_base_quote_uniq;")
+                pgsql.query('ALTER TABLE personal.exchangerate ADD CONSTRAINT base_quote_uniq UNIQUE ("base", "quote");')
+                pgsql.commit()
+
+        add_old_constraint(drop_new=True)
+        ExchangeRate.migrate()
+        self.assertEqual(constraints(), ["exchangerate_base_quote_uniq"])
+        add_old_constraint(drop_new=False)
+        ExchangeRate.migrate()
+        ExchangeRate.migrate()
+        self.assertEqual(constraints(), ["exchangerate_base_quote_uniq"])
+
+    def test_upserts(self):
+        usd = Currency.objects.get(code="USD")
+        rate, created = ExchangeRate.objects.get_or_create(base=usd, quote="EUR", defaults={"rate": 0.9})
+        self.assertTrue(created)
+        self.assertEqual(rate.base.code, "USD")
+        same_rate, created = ExchangeRate.objects.get_or_create(base=usd.id, quote="EUR", defaults={"rate": 0.5})
+        self.assertFalse(created)
+        self.assertEqual((same_rate.id, float(same_rate.rate)), (rate.id, 0.9))
+        rate, created = ExchangeRate.objects.update_or_create(base=usd, quote="EUR", defaults={"rate": 0.7})
+        self.assertEqual((rate.id, float(rate.rate), created), (same_rate.id, 0.7, False))
+        rate, created = ExchangeRate.objects.update_or_create(base=usd, quote="INR", defaults={"rate": 80})
+        self.assertTrue(created)
+        rates = [ExchangeRate(base=usd, quote="EUR", rate=1), ExchangeRate(base=usd, quote="GBP", rate=2),
+                 {"base": usd.id, "quote": "GBP", "rate": 3}]
+        self.assertEqual(ExchangeRate.objects.bulk_upsert(rates, batch_size=2), 3)
+        self.assertEqual(rates[0].id, same_rate.id)
+        self.assertEqual(rates[1].id, rates[2]["id"])
+        self.assertEqual(ExchangeRate.objects.bulk_upsert([{"base": usd.id, "quote": "GBP", "rate": 4}], update_fields=[]), 0)
+        self.assertEqual(
+            sorted((i.quote, i.rate) for i in ExchangeRate.objects.all()),
+            [("EUR", 1), ("GBP", 3), ("INR", 80)]
+        )
+        with self.assertRaises(QueryException):
+            Currency.objects.bulk_upsert([{"code": "XXX"}])
+        ExchangeRate.objects.delete()
+
+    def test_instrumentation(self):
+        before, after = [], []
+        instrumentation.add_before_execute_hook(before.append)
+        instrumentation.add_after_execute_hook(after.append)
+        instrumentation.enable_stats()
+        try:
+            banks = [i for i in Bank.objects.select_related("currency").filter(name__startswith="F")]
+            self.assertEqual(len(banks), 1)
+            self.assertEqual(Currency.objects.filter(code="USD").count(), 1)
+        finally:
+            instrumentation.remove_hook(before.append)
+            instrumentation.remove_hook(after.append)
+            instrumentation.disable_stats()
+        self.assertEqual(len(before), 2)
+        self.assertEqual([i.rows for i in after], [1, 1])
+        self.assertEqual(after[0].params_count, 1)
+        self.assertIn("LEFT JOIN", after[0].sql)
+        self.assertGreater(after[0].compile_time, 0)
+        self.assertGreater(after[0].execute_time, 0)
+        self.assertGreaterEqual(after[0].total_time, after[0].execute_time + after[0].hydrate_time)
+        stats = instrumentation.get_stats()
+        self.assertEqual(stats[after[0].sql]["count"], 1)
+        self.assertLessEqual(stats[after[0].sql]["p50"], stats[after[0].sql]["p99"])
+        instrumentation.STATS.clear()
+        instrumentation.set_slow_query_threshold(0)
+        try:
+            with self.assertLogs("sql_orm.slow_queries", level="WARNING") as logs:
+                Currency.objects.filter(code="USD").exists()
+        finally:
+            instrumentation.set_slow_query_threshold(None)
+        self.assertIn("Slow query", logs.output[0])
+        self.assertFalse(instrumentation.enabled())
+
+    def test_result_cache(self):
+        backend = cache.get_backend()
+        backend.clear()
+
+        def banks():
+            return [i.name for i in Bank.objects.cache(ttl=60).filter(currency__code="USD")]
+
+        self.assertEqual(banks(), ["First Bank name"])
+        with postgresql.PostgreSQL() as pgsql:
+            pgsql.query("UPDATE personal.bank SET name='Raw Bank name' WHERE name='First Bank name';")
+            pgsql.commit()
+        self.assertEqual(banks(), ["First Bank name"])
+        self.assertEqual(backend.stats()["hits"], 1)
+        self.assertEqual(Currency.objects.cache(ttl=60).filter(code="USD").count(), 1)
+        usd = Currency.objects.get(code="USD")
+        usd.code = "USX"
+        usd.save()
+        self.assertEqual(banks(), [])
+        self.assertEqual(Currency.objects.cache(ttl=60).filter(code="USD").count(), 0)
+        with atomic():
+            usd.code = "USD"
+            usd.save()
+            self.assertEqual(banks(), ["Raw Bank name"])
+        self.assertEqual(len(backend), 0)
+        self.assertEqual(banks(), ["Raw Bank name"])
+        Bank.objects.filter(name="Raw Bank name").update(name="First Bank name")
+        self.assertEqual(banks(), ["First Bank name"])
+        names = list(Bank.objects.cache(ttl=60).values_list("name", flat=True).order_by("name"))
+        self.assertEqual(list(Bank.objects.cache(ttl=60).values_list("name", flat=True).order_by("name")), names)
+        self.assertEqual(backend.stats()["hits"], 2)
+        # A write committed while the query runs must keep its (possibly stale) rows out of the cache.
+        backend.clear()
+        invalidate = lambda event: cache.invalidate(Bank)
+        instrumentation.add_before_execute_hook(invalidate)
+        try:
+            self.assertEqual(banks(), ["First Bank name"])
+        finally:
+            instrumentation.remove_hook(invalidate)
+        self.assertEqual(len(backend), 0)
+        small = cache.LRUCacheBackend(maxsize=2)
+        for i in range(3):
+            small.set(i, [(i, )], None, ["personal.bank"], small.generations(["personal.bank"]))
+        self.assertEqual((small.get(0), small.get(2), len(small)), (None, [(2, )], 2))
+        generations = small.generations(["personal.bank"])
+        small.invalidate(["personal.bank"])
+        self.assertEqual(len(small), 0)
+        small.set(3, [(3, )], None, ["personal.bank"], generations)
+        self.assertEqual(len(small), 0)
+        backend.clear()
+
+    def test_explain(self):
+        query = Bank.objects.select_related("currency").filter(name="First Bank name")
+        plan = query.explain()
+        self.assertIsInstance(plan, plans.QueryPlan)
+        self.assertIsNone(plan.execution_time)
+        self.assertIn("bank", [i.get("Relation Name") for i in plan.nodes()])
+        plan = Bank.objects.filter(name="First Bank name").explain(analyze=True, buffers=True)
+        self.assertEqual(plan.root["Actual Rows"], 1)
+        self.assertIsNotNone(plan.execution_time)
+        self.assertIn("Shared Hit Blocks", plan.root)
+        self.assertIn("cost=", Bank.objects.all().explain(format="text"))
+        with self.assertRaises(ValueError):
+            Bank.objects.all().explain(format="html")
+        with postgresql.PostgreSQL() as pgsql:
+            pgsql.query("ANALYZE personal.bank;")
+            pgsql.commit()
+        plans.set_seq_scan_threshold(0)
+        try:
+            with self.assertLogs("sql_orm.plans", level="WARNING") as logs:
+                Bank.objects.filter(name="First Bank name").exists()
+                Bank.objects.filter(name="Second Bank name").exists()
+        finally:
+            plans.set_seq_scan_threshold(None)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("Seq Scan on personal.bank", logs.output[0])
+
+    def test_query_only_defer(self):
+        trans = [i for i in Transactions.objects.filter(amount__lt=3).only("amount").order_by("amount")]
+        self.assertEqual([i.amount for i in trans], [-2, -1, 1, 2])
+        self.assertNotIn("status", trans[0].__dict__)
+        self.assertNotIn("status", trans[1].__dict__)
+        self.assertEqual(trans[0].status, False)
+        self.assertIn("status", trans[1].__dict__)
+        self.assertEqual(trans[1].status, True)
+        self.assertEqual(trans[1].bank.name, "First Bank name")
+        trans = [i for i in Transactions.objects.select_related("bank").only("amount", "bank__name").order_by("amount")]
+        self.assertEqual(trans[0].bank.name, "First Bank name")
+        self.assertNotIn("currency", trans[0].bank.__dict__)
+        self.assertEqual(trans[0].bank.currency.code, "USD")
+        bank = Bank.objects.defer("name").get(currency__code="USD")
+        self.assertNotIn("name", bank.__dict__)
+        self.assertEqual(bank.name, "First Bank name")
+        self.assertEqual(bank.get_dirty_fields(), set())
+        with self.assertRaises(QueryException):
+            Bank.objects.only("address")
+
+    def test_query_iterator(self):
+        trans_1 = [(i.amount, i.bank.name) for i in Transactions.objects.select_related().order_by("amount")]
+        trans_2 = [(i.amount, i.bank.name) for i in Transactions.objects.select_related().order_by("amount").iterator(chunk_size=2)]
+        self.assertEqual(trans_1, trans_2)
+        self.assertEqual(len(trans_2), 5)
+
+    def test_prepared_statements(self):
+        query = "SELECT code FROM personal.currency WHERE code=%s AND code LIKE '%%D';"
+        with postgresql.PostgreSQL(prepare=True) as pgsql:
+            pgsql.prepared_statements.reset()
+            for _ in range(pgsql.prepared_statements.threshold + 1):
+                pgsql.query(query, params=("USD", ))
+                self.assertEqual(pgsql.fetchall(), [("USD", )])
+            self.assertIn(query, pgsql.prepared_statements)
+            pgsql.query("DEALLOCATE ALL;")
+            pgsql.commit()
+            pgsql.query(query, params=("USD", ))
+            self.assertEqual(pgsql.fetchall(), [("USD", )])
+            self.assertNotIn(query, pgsql.prepared_statements)
+
+    def test_query_cache(self):
+        sql.QUERY_CACHE.clear()
+        banks_1 = [i.name for i in Bank.objects.filter(currency__code="USD", name__icontains="bank")]
+        banks_2 = [i.name for i in Bank.objects.filter(currency__code="EUR", name__icontains="bank")]
+        self.assertEqual(banks_1, ["First Bank name"])
+        self.assertEqual(banks_2, ["Second Bank name"])
+        self.assertEqual(sql.QUERY_CACHE.stats()["misses"], 1)
+        self.assertEqual(sql.QUERY_CACHE.stats()["hits"], 1)
+        self.assertEqual(Bank.objects.filter(currency__isnull=True).count(), 0)
+        self.assertEqual(Bank.objects.filter(currency__isnull=False).count(), 3)
+        self.assertEqual(sql.QUERY_CACHE.stats()["misses"], 3)
+        self.assertEqual([i.name for i in Bank.objects.order_by("name")[1:3]], ["Second Bank name", "Third Bank name"])
+        self.assertEqual([i.name for i in Bank.objects.order_by("name")[2:3]], ["Third Bank name"])
+        self.assertEqual(sql.QUERY_CACHE.stats()["hits"], 2)
+
+    def test_table_meta(self):
+        meta = Transactions._meta
+        self.assertEqual(meta.pk_name, "id")
+        self.assertEqual(list(meta.column_names), Transactions.get_column_names())
+        self.assertEqual(list(meta.foreign_keys), ["bank"])
+        self.assertIs(meta.foreign_keys["bank"].table_name, Bank)
+        self.assertEqual(meta.quoted_column_names["amount"], '"amount"')
+        with self.assertRaises(AttributeError):
+            meta.pk_name = "amount"
+        with self.assertRaises(TypeError):
+            meta.fields["amount"] = None
+
+    def test_query_update(self):
+        updated = Transactions.objects.filter(bank__currency__code="EUR").update(status=True)
+        self.assertEqual(updated, 2)
+        self.assertEqual(
+            sorted([i.amount for i in Transactions.objects.filter(status=True)]),
+            [-1, 1, 2]
+        )
+        self.assertEqual(Transactions.objects.filter(amount__in=[1, 2]).update(status=False), 2)
+        self.assertEqual(Transactions.objects.filter(status=True).count(), 1)
+
+    def test_query_update_delete_null_foreign_key(self):
+        Transactions.objects.create(date_of_entry=datetime.now().date(), amount=99, status=False, bank=None)
+        query = {"amount": 99, "bank__currency__isnull": True}
+        self.assertEqual(Transactions.objects.filter(**query).count(), 1)
+        self.assertEqual(Transactions.objects.filter(**query).update(status=True), 1)
+        self.assertEqual(Transactions.objects.or_filter(amount=99, bank__currency__code="ZZZ").count(), 1)
+        self.assertEqual(Transactions.objects.or_filter(amount=99, bank__currency__code="ZZZ").update(status=False), 1)
+        self.assertEqual(Transactions.objects.filter(bank__currency__code="EUR").update(status=True), 2)
+        Transactions.objects.filter(**query).delete()
+        self.assertEqual(Transactions.objects.filter(amount=99).count(), 0)
+        self.assertEqual(Transactions.objects.count(), 5)
+
+    def test_query_bulk_update(self):
+        transactions = [i for i in Transactions.objects.filter(bank__currency__code="EUR").order_by("amount")]
+        for transaction in transactions:
+            transaction.amount += 10
+            transaction.status = True
+        bank = Bank.objects.get(name="Third Bank name")
+        transactions[0].bank = bank
+        self.assertEqual(Transactions.objects.bulk_update(transactions, ["amount", "status", "bank"], batch_size=1), 2)
+        updated = [(i.amount, i.status, i.bank.name) for i in Transactions.objects.filter(id__in=[i.id for i in transactions]).order_by("amount")]
+        self.assertEqual(updated, [(11, True, "Third Bank name"), (12, True, "Second Bank name")])
+        for transaction in transactions:
+            transaction.amount -= 10
+            transaction.status = False
+        transactions[0].bank = transactions[1].bank
+        Transactions.objects.bulk_update(transactions, ["amount", "status", "bank"])
+        self.assertEqual(Transactions.objects.filter(bank__currency__code="EUR").count(), 2)
+
+    def test_save_dirty_fields(self):
+        bank = Bank.objects.get(name="First Bank name")
+        self.assertEqual(bank.get_dirty_fields(), set())
+        Bank.objects.filter(id=bank.id).update(name="Changed Bank name")
+        bank.save()
+        self.assertEqual(Bank.objects.get(id=bank.id).name, "Changed Bank name")
+        bank.name = "First Bank name"
+        self.assertEqual(bank.get_dirty_fields(), {"name"})
+        bank.save()
+        self.assertEqual(bank.get_dirty_fields(), set())
+        self.assertEqual(Bank.objects.get(id=bank.id).name, "First Bank name")
+        bank.name = "Not saved"
+        bank.currency = None
+        bank.save(update_fields=["currency"])
+        self.assertEqual(Bank.objects.get(id=bank.id).name, "First Bank name")
+        self.assertEqual(Bank.objects.filter(id=bank.id, currency__isnull=True).count(), 1)
+        bank.currency = Currency.objects.get(code="USD")
+        bank.save(update_fields=["currency"])
+        self.assertEqual(Bank.objects.get(id=bank.id).currency.code, "USD")
+
     def test_update_object(self):
         obj, _ = Currency.objects.get_or_create(code="UPD")
         obj.code = "TES"